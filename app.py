@@ -1,22 +1,77 @@
-import os
-import csv
-import io
-from typing import Any
+import gzip
+import hashlib
+import json
+import time
+import uuid
+from datetime import datetime
+from typing import Any, Dict, Iterator
 import logging
 import httpx
-from flask import Flask, jsonify, make_response, render_template, request, send_file
+from flask import Flask, Response, g, jsonify, make_response, render_template, request, send_file, stream_with_context, url_for
 from flask_cors import CORS
-from flask_caching import Cache
-from urllib.parse import urlparse
 
-from family.custom_exceptions import FamilyNotFound, WrongIIN, WrongPassword, IINNotInSections
-from family.family import get_family_data
-from excel.excel import get_excel
+from family.analytics import DEFAULT_HISTOGRAM_BINS, get_analytics_store, get_report
+from family.batch import iter_batch_rows, iter_csv, iter_family_data, parse_iins
+from family.custom_exceptions import AnalyticsUnavailable, FamilyNotFound, WrongIIN, WrongPassword, IINNotInSections, NoVPNConnection
+from family.family import get_family_data, iter_family_events
+from family.jobs import REPORT_FORMATS, get_job, submit_job
+from family.logs import set_request_id, setup_logging
+from family.metrics import get_server_timing, metrics, start_request_timings, timed
+from family.utils import get_env_vars
 
 
 flask_app = Flask(__name__)
 CORS(flask_app)
 
+SERVER_TIMING_ENDPOINTS = {'index', 'download_xlsx'}
+access_logger = logging.getLogger('app.access')
+API_MAX_AGE = 300
+API_ERROR_STATUSES = {
+    WrongIIN: 400,
+    FamilyNotFound: 404,
+    IINNotInSections: 404,
+    WrongPassword: 502,
+    NoVPNConnection: 503,
+}
+
+
+@flask_app.before_request
+def start_timings():
+    g.started_at = time.perf_counter()
+    g.timings = start_request_timings()
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+    set_request_id(g.request_id)
+
+
+@flask_app.after_request
+def add_server_timing(response: Response) -> Response:
+    if 'timings' not in g:
+        return response
+
+    total = time.perf_counter() - g.started_at
+    # a copy, the lookups of this request may still be running on the event loop and adding stages
+    timings = dict(g.timings)
+    if request.endpoint in SERVER_TIMING_ENDPOINTS:
+        response.headers['Server-Timing'] = get_server_timing(timings=timings, total=total)
+    response.headers['X-Request-ID'] = g.request_id
+    access_logger.log(
+        logging.WARNING if response.status_code >= 500 else logging.INFO,
+        f'{request.method} {request.path} {response.status_code}',
+        extra={
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'duration_ms': round(total * 1000, 1),
+            'timings_ms': {stage: round(seconds * 1000, 1) for stage, seconds in timings.items()},
+        }
+    )
+    return response
+
+
+@flask_app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 
 @flask_app.route('/download_xlsx', methods=['GET'])
 def download_xlsx():
@@ -24,8 +79,173 @@ def download_xlsx():
     flask_app.logger.info(f'IIN: {iin}')
     if not iin:
         raise WrongIIN()
+    # openpyxl is only imported by the workers that actually export something
+    from excel.excel import get_excel_file, get_excel_name
+
     family = get_family_data(iin=iin)
-    return send_file(get_excel(family=family), as_attachment=True)
+    with timed('xlsx'):
+        report = get_excel_file(family=family)
+
+    def send_report() -> Response:
+        # a file path lets the server hand the report to sendfile, the content hash doubles as the ETag
+        return send_file(
+            report.path, as_attachment=True, download_name=get_excel_name(family=family),
+            etag=report.key, last_modified=report.created_at, conditional=True
+        )
+
+    try:
+        response = send_report()
+    except FileNotFoundError:
+        # another worker evicted the file between get_excel_file and send_file, so it is built again
+        with timed('xlsx'):
+            report = get_excel_file(family=family)
+        response = send_report()
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def get_json_response(data: Any) -> Response:
+    """JSON response with a content-hash ETag, answered with 304 if the client already has it
+    and gzipped if the client accepts it.
+    """
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+
+    response = make_response(body)
+    response.content_type = 'application/json; charset=utf-8'
+    # weak, because the gzipped and the plain body carry the same ETag
+    response.set_etag(hashlib.sha256(body).hexdigest()[:32], weak=True)
+    response.cache_control.private = True
+    response.cache_control.max_age = API_MAX_AGE
+    response.vary.add('Accept-Encoding')
+    response = response.make_conditional(request)
+
+    if response.status_code == 200 and request.accept_encodings['gzip']:
+        response.set_data(gzip.compress(body))
+        response.content_encoding = 'gzip'
+    return response
+
+
+@flask_app.route('/api/family/<iin>', methods=['GET'])
+def family_api(iin: str):
+    try:
+        family = get_family_data(iin=iin)
+    except tuple(API_ERROR_STATUSES) as e:
+        return jsonify({'error': e.error_msg}), API_ERROR_STATUSES[type(e)]
+    return get_json_response(data=family)
+
+
+def get_sse(event: str, data: Dict) -> str:
+    return f'event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+def iter_family_sse(iin: str) -> Iterator[str]:
+    try:
+        for event, data in iter_family_events(iin=iin):
+            if event in ('family', 'done'):
+                # the page swaps the rendered portrait in, so its markup stays in one template
+                data = {'html': render_template('family.html', family=data, data=iin)}
+            yield get_sse(event=event, data=data)
+    except tuple(API_ERROR_STATUSES) as e:
+        yield get_sse(event='error', data={'error': e.error_msg})
+    except (httpx.ConnectTimeout, httpx.ReadTimeout, httpx.ConnectError):
+        yield get_sse(event='error', data={'error': NoVPNConnection().error_msg})
+
+
+@flask_app.route('/stream/family/<iin>', methods=['GET'])
+def family_stream(iin: str):
+    flask_app.logger.info(f'Stream IIN: {iin}')
+    response = Response(stream_with_context(iter_family_sse(iin=iin)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # nginx would otherwise hold the events back until its buffer fills
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@flask_app.route('/api/analytics', methods=['GET'])
+def analytics():
+    bins = request.args.get('bins', type=int) or DEFAULT_HISTOGRAM_BINS
+    # an ISO date, like the --since of python -m family.analytics
+    since = request.args.get('since', type=lambda value: datetime.fromisoformat(value).timestamp())
+    try:
+        report = get_report(store=get_analytics_store(), bins=bins, since=since)
+    except AnalyticsUnavailable as e:
+        return jsonify({'error': e.error_msg}), 501
+    return jsonify(report)
+
+
+def get_request_iins() -> list:
+    upload = request.files.get('file')
+    text = upload.read().decode('utf-8-sig') if upload else request.form.get('iins', '')
+    return parse_iins(text=text)
+
+
+@flask_app.route('/batch', methods=['POST'])
+def batch():
+    iins = get_request_iins()
+    if not iins:
+        return jsonify({'error': 'Введите ИИН'}), 400
+
+    output_format = request.form.get('format', 'csv')
+    concurrency = request.form.get('concurrency', type=int)
+    flask_app.logger.info(f'Batch of {len(iins)} IINs, format: {output_format}')
+
+    rows = iter_batch_rows(iter_family_data(iins=iins, concurrency=concurrency))
+    if output_format == 'xlsx':
+        from excel.excel import get_batch_excel
+
+        return send_file(get_batch_excel(rows=rows), as_attachment=True, download_name='families.xlsx')
+
+    response = Response(stream_with_context(iter_csv(rows=rows)), mimetype='text/csv')
+    response.headers['Content-Disposition'] = 'attachment; filename=families.csv'
+    return response
+
+
+def get_job_response(job) -> Dict:
+    return {
+        **job.to_dict(),
+        'status_url': url_for('report_status', job_id=job.id),
+        'download_url': url_for('download_report', job_id=job.id),
+    }
+
+
+@flask_app.route('/reports', methods=['POST'])
+def submit_report():
+    iins = get_request_iins()
+    if not iins:
+        return jsonify({'error': 'Введите ИИН'}), 400
+
+    report_format = request.form.get('format', 'xlsx')
+    if report_format not in REPORT_FORMATS:
+        return jsonify({'error': f"Формат отчета должен быть одним из: {', '.join(REPORT_FORMATS)}"}), 400
+
+    job = submit_job(report_format=report_format, iins=iins, concurrency=request.form.get('concurrency', type=int))
+    flask_app.logger.info(f'Report job {job.id} of {len(iins)} IINs, format: {report_format}')
+
+    response = jsonify(get_job_response(job))
+    response.status_code = 202
+    response.headers['Location'] = url_for('report_status', job_id=job.id)
+    return response
+
+
+@flask_app.route('/reports/<job_id>', methods=['GET'])
+def report_status(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Отчет не найден'}), 404
+    return jsonify(get_job_response(job))
+
+
+@flask_app.route('/reports/<job_id>/download', methods=['GET'])
+def download_report(job_id: str):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Отчет не найден'}), 404
+    if job.status == 'failed':
+        return jsonify({'error': job.error}), 409
+    if job.status != 'done':
+        return jsonify({'error': 'Отчет еще не готов'}), 409
+    return send_file(job.path, as_attachment=True, download_name=job.get_download_name(), etag=job.id)
 
 
 @flask_app.route('/', methods=['GET', 'POST'])
@@ -33,10 +253,6 @@ def index() -> str:
     iin = request.form.get('data', '')
 
     base_html = 'base.html'
-    cache.set('family', None, timeout=43200)
-
-    flask_app.logger.info(urlparse(request.url))
-    flask_app.logger.info(request.path)
 
     if request.method != 'POST':
         return render_template(base_html, data=iin, family=None, error=None)
@@ -49,20 +265,18 @@ def index() -> str:
 
     try:
         family = get_family_data(iin)    
-    except (FamilyNotFound, WrongIIN, WrongPassword, IINNotInSections) as e:
+    except (FamilyNotFound, WrongIIN, WrongPassword, IINNotInSections, NoVPNConnection) as e:
         error_msg = e.error_msg
     except (httpx.ConnectTimeout, httpx.ReadTimeout, httpx.ConnectError):
-        error_msg = 'Нет подключения к VPN на сервере. Свяжитесь с администраторами'
+        error_msg = NoVPNConnection().error_msg
 
     return render_template('base.html', data=iin, family=family if family else None, error=error_msg)
 
 
+# a missing upstream configuration fails the worker at start instead of its first lookup
+get_env_vars()
+
 if __name__ == '__main__':
     flask_app.run()
 else:
-    logging.basicConfig(filename='record.log', level=logging.DEBUG,
-                        format='%(asctime)s %(levelname)s %(name)s %(threadName)s : %(message)s',
-                        encoding='utf-8')
-    logging.getLogger('httpcore').setLevel(logging.WARNING)
-
-    cache = Cache(flask_app, config={'CACHE_TYPE': 'simple'})
+    setup_logging()
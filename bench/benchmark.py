@@ -0,0 +1,217 @@
+"""Offline benchmark of the lookup pipeline against bench.mock_upstream.
+
+    python -m bench.benchmark --scenario lookup --requests 200 --concurrency 8 --latency 0.05
+    python -m bench.benchmark --scenario routes --json
+
+Every run gets its own temporary caches and metrics directory, so results are cold unless
+--warm is passed, which runs the same IINs once before measuring. --section-index syncs the
+section index from the mock before measuring and draws the IINs from the households it lists.
+
+--connect-latency makes the mock charge every new connection for the handshakes, which is what
+HTTP/2 saves. The mock only speaks HTTP/1.1, so against it --http2 shows the fallback; the gain
+itself is measured with --upstream pointing at the real API over TLS.
+
+--slow-rate gives the mock a long tail of slow responses; --hedge turns on hedged requests
+and reports how many calls were hedged and how many of the hedges answered first.
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from bench.mock_upstream import add_mock_arguments, get_mock_config, start_mock_upstream
+
+
+SCENARIOS = ('lookup', 'excel', 'routes')
+
+
+@dataclass
+class BenchResult:
+    scenario: str
+    requests: int
+    errors: int
+    concurrency: int
+    http2: bool
+    hedge: bool
+    elapsed: float
+    throughput: float
+    p50_ms: float
+    p90_ms: float
+    p99_ms: float
+    max_ms: float
+    upstream: Dict[str, int]
+    hedging: Dict[str, Any]
+
+
+def get_percentile(latencies: List[float], percentile: float) -> float:
+    if not latencies:
+        return 0.0
+    ordered = sorted(latencies)
+    index = min(len(ordered) - 1, max(0, int(round(percentile / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def generate_iins(count: int, seed: int, population: Optional[int] = None) -> List[str]:
+    # one IIN per household, the mock derives the other members from the first 8 digits
+    rnd = random.Random(seed)
+    households = range(10 ** 7, 10 ** 7 + population) if population else range(10 ** 7, 10 ** 8)
+    return [f'{household}0000' for household in rnd.sample(households, count)]
+
+
+def run_load(func: Callable[[str], None], iins: List[str], concurrency: int) -> Tuple[List[float], int, float]:
+    latencies = []
+    errors = 0
+
+    from family.custom_exceptions import FamilyNotFound, IINNotInSections
+
+    def call(iin: str) -> Optional[float]:
+        start_time = time.perf_counter()
+        try:
+            func(iin)
+        except (FamilyNotFound, IINNotInSections):
+            # a regular answer of the upstream, the UI shows it as a message
+            pass
+        except Exception:
+            return None
+        return time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for latency in executor.map(call, iins):
+            if latency is None:
+                errors += 1
+            else:
+                latencies.append(latency)
+    return latencies, errors, time.perf_counter() - start_time
+
+
+def get_scenario(scenario: str) -> Callable[[str], None]:
+    # imported lazily, after the environment points the pipeline at the mock upstream
+    from family.family import get_family_data
+    from excel.excel import get_excel
+
+    if scenario == 'lookup':
+        return get_family_data
+
+    if scenario == 'excel':
+        def build_excel(iin: str) -> None:
+            get_excel(family=get_family_data(iin=iin))
+        return build_excel
+
+    from app import flask_app
+
+    client = flask_app.test_client()
+
+    def request_routes(iin: str) -> None:
+        response = client.post('/', data={'data': iin})
+        if response.status_code != 200:
+            raise RuntimeError(response.status_code)
+        if b'family-portrait' not in response.data:
+            return
+        response = client.get(f'/download_xlsx?iin={iin}')
+        if response.status_code != 200:
+            raise RuntimeError(response.status_code)
+    return request_routes
+
+
+def get_hedging_stats() -> Dict[str, Any]:
+    from family.auth import get_token_manager
+    from family.runtime import run_sync
+
+    async def get_stats() -> Dict[str, Any]:
+        hedger = get_token_manager().upstream.hedger
+        return hedger.get_stats() if hedger is not None else {}
+
+    return run_sync(get_stats())
+
+
+def run_benchmark(args: argparse.Namespace) -> BenchResult:
+    if args.upstream:
+        url, stats = args.upstream, {}
+    else:
+        _, url, stats = start_mock_upstream(config=get_mock_config(args=args))
+
+    work_dir = tempfile.mkdtemp(prefix='arta_bench_')
+    os.environ.update({
+        'URL': url,
+        'USR': os.getenv('USR', 'bench'),
+        'PSW': os.getenv('PSW', 'bench'),
+        'PROFILE_CACHE_PATH': os.path.join(work_dir, 'profiles.sqlite3'),
+        'METRICS_DIR': os.path.join(work_dir, 'metrics'),
+        'SECTION_INDEX_PATH': os.path.join(work_dir, 'sections.sqlite3'),
+        'REPORT_CACHE_DIR': os.path.join(work_dir, 'reports'),
+        'ANALYTICS_DIR': os.path.join(work_dir, 'analytics'),
+        # the periodic sync would compete with the measured requests
+        'SECTION_SYNC_INTERVAL': '0',
+        'UPSTREAM_HTTP2': '1' if args.http2 else '0',
+        'UPSTREAM_HEDGE': '1' if args.hedge else '0',
+    })
+
+    func = get_scenario(scenario=args.scenario)
+    if args.section_index:
+        from family.runtime import run_sync
+        from family.section_index import sync_sections
+
+        run_sync(sync_sections(interval=0, page_size=1000))
+    iins = generate_iins(count=args.requests, seed=args.seed, population=args.population if args.section_index else None)
+    if args.warm:
+        run_load(func=func, iins=iins, concurrency=args.concurrency)
+    for key in stats:
+        stats[key] = 0
+
+    latencies, errors, elapsed = run_load(func=func, iins=iins, concurrency=args.concurrency)
+    return BenchResult(
+        scenario=args.scenario,
+        requests=len(iins),
+        errors=errors,
+        concurrency=args.concurrency,
+        http2=args.http2,
+        hedge=args.hedge,
+        elapsed=round(elapsed, 3),
+        throughput=round(len(iins) / elapsed, 2),
+        p50_ms=round(get_percentile(latencies, 50) * 1000, 1),
+        p90_ms=round(get_percentile(latencies, 90) * 1000, 1),
+        p99_ms=round(get_percentile(latencies, 99) * 1000, 1),
+        max_ms=round(max(latencies, default=0) * 1000, 1),
+        upstream=dict(stats),
+        hedging=get_hedging_stats(),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Offline benchmark of the family lookup pipeline')
+    parser.add_argument('--scenario', choices=SCENARIOS, default='lookup')
+    parser.add_argument('-n', '--requests', type=int, default=100)
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--warm', action='store_true', help='run the IINs once before measuring')
+    parser.add_argument('--section-index', action='store_true', help='sync the section index before measuring')
+    parser.add_argument('--http2', action='store_true', help='talk HTTP/2 to the upstream if it offers it (needs h2)')
+    parser.add_argument('--hedge', action='store_true', help='hedge slow person-detail and section calls')
+    parser.add_argument('--upstream', help='URL of an already running upstream instead of the built-in mock')
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    add_mock_arguments(parser=parser)
+    args = parser.parse_args()
+
+    result = run_benchmark(args=args)
+    if args.json:
+        print(json.dumps(asdict(result)))
+        return
+
+    print(f'{result.scenario}: {result.requests} requests, {result.errors} errors, concurrency {result.concurrency}'
+          + (', http2' if result.http2 else '') + (', hedged' if result.hedge else ''))
+    print(f'  elapsed {result.elapsed:.3f} s, throughput {result.throughput:.2f} req/s')
+    print(f'  latency p50 {result.p50_ms} ms, p90 {result.p90_ms} ms, p99 {result.p99_ms} ms, max {result.max_ms} ms')
+    if result.upstream:
+        print('  upstream calls: ' + ', '.join(f'{key}={value}' for key, value in result.upstream.items()))
+    if result.hedging:
+        print('  hedging: ' + ', '.join(f'{key}={value}' for key, value in result.hedging.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+import argparse
+import base64
+import hashlib
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple, Type
+
+from family.sections import REQUIRED_SECTIONS
+from family.utils import RISK_CODES, SOCIAL_STATUSES
+
+
+@dataclass
+class MockConfig:
+    latency: float = 0.05
+    connect_latency: float = 0.0
+    jitter: float = 0.02
+    # share of responses that take slow_latency instead, the long tail hedging is meant for
+    slow_rate: float = 0.0
+    slow_latency: float = 1.0
+    error_rate: float = 0.0
+    min_members: int = 1
+    max_members: int = 6
+    section_hit_rate: float = 0.9
+    not_found_rate: float = 0.05
+    token_ttl: int = 600
+    population: int = 2000
+
+
+def get_seed(iin: str) -> int:
+    # every IIN always gets the same family, so repeated runs are comparable
+    return int(hashlib.md5(iin.encode()).hexdigest()[:8], 16)
+
+
+def get_fake_token(ttl: int) -> str:
+    def encode(data: Dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+
+    return f"{encode({'alg': 'none'})}.{encode({'exp': int(time.time()) + ttl})}.mock"
+
+
+def get_member_iins(iin: str, config: MockConfig) -> List[str]:
+    # members of one household share the leading digits, so relatives map to the same family
+    household = iin[:8]
+    rnd = random.Random(get_seed(household))
+    member_cnt = rnd.randint(config.min_members, config.max_members)
+    members = [f'{household}{i:04d}' for i in range(member_cnt)]
+    if iin not in members:
+        members[0] = iin
+    return members
+
+
+def get_family_info(iin: str, config: MockConfig) -> Dict:
+    rnd = random.Random(get_seed(iin[:8]))
+    if rnd.random() < config.not_found_rate:
+        return {'family': None, 'familyMemberList': []}
+
+    members = get_member_iins(iin=iin, config=config)
+    child_cnt = rnd.randint(0, len(members) - 1) if len(members) > 1 else 0
+    return {
+        'family': {
+            'familyQuality': {
+                'cntMem': len(members),
+                'cntChild': child_cnt,
+                'tzhsDictionary': {'nameRu': rnd.choice(['A', 'B', 'C', 'D', 'E'])},
+                'incomeOop': rnd.randint(0, 900000),
+                'incomeCbd': rnd.choice([None, rnd.randint(0, 200000)]),
+                'sdd': round(rnd.uniform(0, 150000), 2),
+                'sddAsp': rnd.choice([None, rnd.randint(0, 50000)]),
+                'familyPm': {'nameRu': rnd.choice(['Ниже ЧБ', 'Выше ЧБ', 'Ниже ПМ'])},
+                'needEdu': rnd.randint(0, 1),
+                'needEmp': rnd.randint(0, 1),
+                'needMed': rnd.randint(0, 1),
+                'needNedv': rnd.randint(0, 1),
+                'cntLand': rnd.randint(0, 2),
+                'cntEmp': rnd.randint(0, len(members)),
+                'cntCbd': rnd.randint(0, len(members)),
+                'cntNedv': rnd.randint(0, 2),
+                'cntDv': rnd.randint(0, 2),
+                'riskDetail': ''.join(code if rnd.random() < 0.3 else 'N' for code in RISK_CODES),
+            }
+        },
+        'addressRu': f'г. Алматы, ул. Тестовая {rnd.randint(1, 300)}',
+        'familyMemberList': [{'iin': member, 'fullName': f'ТЕСТОВ ЧЛЕН {i}'} for i, member in enumerate(members, start=1)],
+    }
+
+
+def get_person_details(iin: str) -> Dict:
+    rnd = random.Random(get_seed(iin))
+    statuses = rnd.sample(SOCIAL_STATUSES, rnd.randint(0, 3))
+    return {'personSourceList': [{'status': {'nameRu': status}} for status in statuses]}
+
+
+def get_section_total(iin: str, section: int, config: MockConfig) -> int:
+    rnd = random.Random(get_seed(iin))
+    if rnd.random() >= config.section_hit_rate:
+        return 0
+    # skewed towards the first sections, like the real hit distribution
+    hit_section = REQUIRED_SECTIONS[min(int(rnd.expovariate(1.0)), len(REQUIRED_SECTIONS) - 1)]
+    return int(section == hit_section)
+
+
+def get_population(config: MockConfig) -> List[str]:
+    # households listed by stat/page without an IIN, used by the section index sync
+    return [f'{household}0000' for household in range(10 ** 7, 10 ** 7 + config.population)]
+
+
+def get_section_members(config: MockConfig) -> Dict[int, List[str]]:
+    members = {section: [] for section in REQUIRED_SECTIONS}
+    for iin in get_population(config=config):
+        for member in get_member_iins(iin=iin, config=config):
+            for section in REQUIRED_SECTIONS:
+                if get_section_total(iin=member, section=section, config=config):
+                    members[section].append(member)
+    return members
+
+
+def create_handler(config: MockConfig) -> Tuple[Type[BaseHTTPRequestHandler], Dict[str, int]]:
+    stats = {'connections': 0, 'login': 0, 'stat_page': 0, 'family_info': 0, 'person_details': 0, 'errors': 0}
+    stats_lock = threading.Lock()
+    section_members = {}
+
+    def count(name: str) -> None:
+        with stats_lock:
+            stats[name] += 1
+
+    def login(body: Dict) -> Dict:
+        return {'accessToken': get_fake_token(ttl=config.token_ttl)}
+
+    def stat_page(body: Dict) -> Dict:
+        if body['iin']:
+            return {'total': get_section_total(iin=body['iin'], section=body['countid'], config=config), 'content': []}
+
+        with stats_lock:
+            if not section_members:
+                section_members.update(get_section_members(config=config))
+        members = section_members.get(body['countid'], [])
+        start = (body['page'] - 1) * body['size']
+        return {'total': len(members), 'content': [{'iin': iin} for iin in members[start:start + body['size']]]}
+
+    def family_info(body: Dict) -> Dict:
+        return get_family_info(iin=body['iin'], config=config)
+
+    def person_details(body: Dict) -> Dict:
+        return get_person_details(iin=body['iin'])
+
+    routes: Dict[str, Tuple[str, Callable[[Dict], Dict]]] = {
+        '/auth/login': ('login', login),
+        '/api/workspace/stat/page': ('stat_page', stat_page),
+        '/api/card/familyInfo': ('family_info', family_info),
+        '/api/card/getPersonDetailsDTOByIin': ('person_details', person_details),
+    }
+
+    class Handler(BaseHTTPRequestHandler):
+        # keep-alive like the real API, the werkzeug dev server closes every connection
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self) -> None:
+            super().setup()
+            count('connections')
+            # a new connection pays for the TCP and TLS handshakes over the VPN
+            if config.connect_latency:
+                time.sleep(config.connect_latency)
+
+        def log_message(self, format: str, *args) -> None:
+            # the per-request access log would dominate the benchmark output
+            pass
+
+        def send_json(self, status: int, data: Dict) -> None:
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self) -> None:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if config.slow_rate and random.random() < config.slow_rate:
+                time.sleep(config.slow_latency)
+            elif config.latency or config.jitter:
+                time.sleep(max(0.0, random.gauss(config.latency, config.jitter)))
+
+            route = routes.get(self.path)
+            if route is None:
+                return self.send_json(404, {'error': 'not found'})
+            if self.path != '/auth/login' and not self.headers.get('Authorization', '').startswith('Bearer '):
+                return self.send_json(401, {'error': 'unauthorized'})
+            if config.error_rate and random.random() < config.error_rate:
+                count('errors')
+                return self.send_json(503, {'error': 'unavailable'})
+
+            name, handle = route
+            count(name)
+            self.send_json(200, handle(json.loads(body or b'{}')))
+
+    return Handler, stats
+
+
+def start_mock_upstream(config: MockConfig, host: str = '127.0.0.1', port: int = 0) -> Tuple[ThreadingHTTPServer, str, Dict[str, int]]:
+    handler, stats = create_handler(config=config)
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name='mock-upstream', daemon=True).start()
+    return server, f'http://{host}:{server.server_port}', stats
+
+
+def add_mock_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = MockConfig()
+    parser.add_argument('--latency', type=float, default=defaults.latency, help='mean upstream latency, seconds')
+    parser.add_argument('--connect-latency', type=float, default=defaults.connect_latency, help='extra latency of a new connection')
+    parser.add_argument('--jitter', type=float, default=defaults.jitter, help='standard deviation of the latency')
+    parser.add_argument('--slow-rate', type=float, default=defaults.slow_rate, help='share of responses that take --slow-latency')
+    parser.add_argument('--slow-latency', type=float, default=defaults.slow_latency, help='latency of the slow responses, seconds')
+    parser.add_argument('--error-rate', type=float, default=defaults.error_rate, help='share of 503 responses')
+    parser.add_argument('--min-members', type=int, default=defaults.min_members)
+    parser.add_argument('--max-members', type=int, default=defaults.max_members)
+    parser.add_argument('--section-hit-rate', type=float, default=defaults.section_hit_rate)
+    parser.add_argument('--not-found-rate', type=float, default=defaults.not_found_rate)
+    parser.add_argument('--population', type=int, default=defaults.population, help='households listed by stat/page')
+
+
+def get_mock_config(args: argparse.Namespace) -> MockConfig:
+    return MockConfig(
+        latency=args.latency,
+        connect_latency=args.connect_latency,
+        jitter=args.jitter,
+        slow_rate=args.slow_rate,
+        slow_latency=args.slow_latency,
+        error_rate=args.error_rate,
+        min_members=args.min_members,
+        max_members=args.max_members,
+        section_hit_rate=args.section_hit_rate,
+        not_found_rate=args.not_found_rate,
+        population=args.population,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Local stand-in for the social card API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5999)
+    add_mock_arguments(parser=parser)
+    args = parser.parse_args()
+
+    handler, _ = create_handler(config=get_mock_config(args=args))
+    ThreadingHTTPServer((args.host, args.port), handler).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
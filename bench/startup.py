@@ -0,0 +1,118 @@
+"""Import time of the app and latency of the first requests of a fresh worker, against bench.mock_upstream.
+
+    python -m bench.startup --runs 5
+    python -m bench.startup --json
+
+Every run is a new interpreter, so nothing is warm except the OS file cache.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List
+
+from bench.mock_upstream import add_mock_arguments, get_mock_config, start_mock_upstream
+
+
+# modules that are only needed by some requests and should not be loaded at worker start
+LAZY_MODULES = ('openpyxl',)
+
+
+@dataclass
+class StartupResult:
+    runs: int
+    import_ms: float
+    first_request_ms: float
+    second_request_ms: float
+    lazy_modules_loaded: Dict[str, bool]
+
+
+def measure_worker(iins: List[str]) -> Dict:
+    """Runs in the child interpreter: imports the app like a gunicorn worker and serves two lookups."""
+    start_time = time.perf_counter()
+    from app import flask_app
+    import_time = time.perf_counter() - start_time
+
+    client = flask_app.test_client()
+    timings = []
+    for iin in iins:
+        start_time = time.perf_counter()
+        client.post('/', data={'data': iin})
+        timings.append(time.perf_counter() - start_time)
+
+    return {
+        'import': import_time,
+        'first_request': timings[0],
+        'second_request': timings[1],
+        'lazy_modules_loaded': {module: module in sys.modules for module in LAZY_MODULES},
+    }
+
+
+def run_startup(args: argparse.Namespace) -> StartupResult:
+    _, url, _ = start_mock_upstream(config=get_mock_config(args=args))
+
+    samples = []
+    for run in range(args.runs):
+        work_dir = tempfile.mkdtemp(prefix='arta_startup_')
+        env = {
+            **os.environ,
+            'URL': url,
+            'USR': os.getenv('USR', 'bench'),
+            'PSW': os.getenv('PSW', 'bench'),
+            'PROFILE_CACHE_PATH': os.path.join(work_dir, 'profiles.sqlite3'),
+            'METRICS_DIR': os.path.join(work_dir, 'metrics'),
+            'SECTION_INDEX_PATH': os.path.join(work_dir, 'sections.sqlite3'),
+            'SECTION_SYNC_INTERVAL': '0',
+            'REPORT_CACHE_DIR': os.path.join(work_dir, 'reports'),
+            'ANALYTICS_DIR': os.path.join(work_dir, 'analytics'),
+            'LOG_FILE': os.path.join(work_dir, 'record.log'),
+        }
+        # two different households, so the second request is a lookup on a warm worker, not a cache hit
+        iins = [f'{10 ** 7 + 2 * run}0000', f'{10 ** 7 + 2 * run + 1}0000']
+        output = subprocess.run(
+            [sys.executable, '-m', 'bench.startup', '--child', *iins],
+            env=env, check=True, capture_output=True, text=True
+        ).stdout
+        samples.append(json.loads(output.strip().splitlines()[-1]))
+
+    def median_ms(key: str) -> float:
+        return round(statistics.median(sample[key] for sample in samples) * 1000, 1)
+
+    return StartupResult(
+        runs=args.runs,
+        import_ms=median_ms('import'),
+        first_request_ms=median_ms('first_request'),
+        second_request_ms=median_ms('second_request'),
+        lazy_modules_loaded={module: any(sample['lazy_modules_loaded'][module] for sample in samples) for module in LAZY_MODULES},
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Worker start-up benchmark')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help='print the result as JSON')
+    parser.add_argument('--child', nargs=2, metavar='IIN', help=argparse.SUPPRESS)
+    add_mock_arguments(parser=parser)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(measure_worker(iins=args.child)))
+        return
+
+    result = run_startup(args=args)
+    if args.json:
+        print(json.dumps(asdict(result)))
+        return
+
+    print(f'startup: median of {result.runs} fresh workers')
+    print(f'  import {result.import_ms} ms, first request {result.first_request_ms} ms, second request {result.second_request_ms} ms')
+    print('  loaded at start: ' + ', '.join(f'{module}={loaded}' for module, loaded in result.lazy_modules_loaded.items()))
+
+
+if __name__ == '__main__':
+    main()
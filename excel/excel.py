@@ -1,43 +1,82 @@
-from typing import Any, Dict 
-from openpyxl import Workbook, styles
+import io
+from typing import Any, Dict, Iterable, List
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Font, NamedStyle, PatternFill
 from openpyxl.styles.borders import Border, Side
 from openpyxl.utils.cell import get_column_letter
-from openpyxl.worksheet.worksheet import Worksheet
+from openpyxl.worksheet._write_only import WriteOnlyWorksheet
 
+try:
+    from excel.report_cache import CachedReport, get_report_cache
+except (ModuleNotFoundError, ImportError):
+    from report_cache import CachedReport, get_report_cache
 
-def get_active_worksheet(wb: Workbook) -> Worksheet or None:
-    return wb.worksheets[0]
+
+HEADER_STYLE = 'header'
+DATA_STYLE = 'data'
+DATA_CENTER_STYLE = 'data_center'
+COLUMN_WIDTH = 15
 
 
 def get_side(style: str = 'thin', color: str = '000000'):
     return Side(style=style, color=color)
 
 
-def write_data(worksheet: Worksheet, family: Dict):
-    for i, (header, data) in enumerate(family.items(), start=2):
-        header_cell = worksheet.cell(column=i, row=1)
-        header_cell.value = header
-        header_cell.alignment = styles.Alignment(vertical='top', horizontal='center', wrap_text=True)
-        header_cell.font = styles.Font(bold=True)
-        header_cell.fill = styles.PatternFill(start_color='D9D9D9', end_color='D9D9D9', fill_type = 'solid')
-        header_cell.border = Border(bottom=get_side(style='thin'), left=get_side(style='thin'), right=get_side(style='thin'))
-
-        data_cell = worksheet.cell(column=i, row=2)
-        data_cell.value = data
-        if isinstance(data, (int, float)) or ' ' not in data:
-            data_cell.alignment = styles.Alignment(vertical='center', horizontal='center', wrap_text=True)
-        else:
-            data_cell.alignment = styles.Alignment(vertical='center', wrap_text=True)
-        data_cell.border = Border(bottom=get_side(style='thin'), left=get_side(style='thin'), right=get_side(style='thin'))
-
-
-def set_column_width(worksheet: Worksheet, width: int):
-    for i in range(2, worksheet.max_column + 1):
-        if worksheet.cell(column=i, row=1).value is None:
-            break
+# openpyxl style objects are immutable values, so they are built once and shared by every workbook
+BORDER = Border(bottom=get_side(style='thin'), left=get_side(style='thin'), right=get_side(style='thin'))
+HEADER_ALIGNMENT = Alignment(vertical='top', horizontal='center', wrap_text=True)
+HEADER_FONT = Font(bold=True)
+HEADER_FILL = PatternFill(start_color='D9D9D9', end_color='D9D9D9', fill_type='solid')
+DATA_ALIGNMENT = Alignment(vertical='center', wrap_text=True)
+DATA_CENTER_ALIGNMENT = Alignment(vertical='center', horizontal='center', wrap_text=True)
+
+
+def add_named_styles(workbook: Workbook) -> None:
+    workbook.add_named_style(NamedStyle(name=HEADER_STYLE, font=HEADER_FONT, fill=HEADER_FILL, alignment=HEADER_ALIGNMENT, border=BORDER))
+    workbook.add_named_style(NamedStyle(name=DATA_STYLE, alignment=DATA_ALIGNMENT, border=BORDER))
+    workbook.add_named_style(NamedStyle(name=DATA_CENTER_STYLE, alignment=DATA_CENTER_ALIGNMENT, border=BORDER))
+
+
+def create_workbook() -> Workbook:
+    workbook = Workbook(write_only=True)
+    add_named_styles(workbook=workbook)
+    return workbook
+
+
+def get_cell(worksheet: WriteOnlyWorksheet, value: Any, style: str) -> WriteOnlyCell:
+    cell = WriteOnlyCell(worksheet, value=value)
+    cell.style = style
+    return cell
+
+
+def get_data_style(data: Any) -> str:
+    if data is None or isinstance(data, (int, float)) or ' ' not in data:
+        return DATA_CENTER_STYLE
+    return DATA_STYLE
+
+
+def set_column_width(worksheet: WriteOnlyWorksheet, column_cnt: int, width: int, start: int = 1):
+    # write-only worksheets only accept column dimensions before the first row is appended
+    for i in range(start, start + column_cnt):
         worksheet.column_dimensions[get_column_letter(i)].width = width
 
 
+def write_header(worksheet: WriteOnlyWorksheet, header: List[Any], offset: int = 0):
+    worksheet.append([None] * offset + [get_cell(worksheet=worksheet, value=value, style=HEADER_STYLE) for value in header])
+
+
+def write_row(worksheet: WriteOnlyWorksheet, row: List[Any], offset: int = 0):
+    worksheet.append([None] * offset + [get_cell(worksheet=worksheet, value=value, style=get_data_style(value)) for value in row])
+
+
+def save_workbook(workbook: Workbook) -> io.BytesIO:
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    buffer.seek(0)
+    return buffer
+
+
 def format_data(family: Dict) -> Dict:
     formatted_dict = dict()
 
@@ -48,7 +87,7 @@ def format_data(family: Dict) -> Dict:
         elif type(val) is dict:
             for key2, val2 in val.items():
                 if key == 'Активы семьи' and val2 == 0:
-                    continue    
+                    continue
                 formatted_dict[key2] = val2 if type(val2) != float else round(val2, 2)
         elif type(val) is list:
             my_key = 'Рекомендация' if key == 'Рекомендации' else 'Риск'
@@ -58,19 +97,48 @@ def format_data(family: Dict) -> Dict:
     return formatted_dict
 
 
-def get_excel(family: Any = None) -> str:
-    excel_name = f"excel/{family['Члены семьи'][0]['ИИН']}.xlsx"
+def get_excel_name(family: Dict) -> str:
+    return f"{family['Члены семьи'][0]['ИИН']}.xlsx"
+
+
+def get_report_data(family: Dict) -> Dict:
+    return format_data({key: value for key, value in family.items() if family[key]})
+
+
+def build_excel(family: Dict) -> io.BytesIO:
+    workbook = create_workbook()
+    worksheet = workbook.create_sheet()
+
+    # the portrait starts in column B, as in the original report layout
+    set_column_width(worksheet=worksheet, column_cnt=len(family), width=COLUMN_WIDTH, start=2)
+    write_header(worksheet=worksheet, header=list(family.keys()), offset=1)
+    write_row(worksheet=worksheet, row=list(family.values()), offset=1)
+
+    return save_workbook(workbook=workbook)
+
+
+def get_excel(family: Any = None) -> io.BytesIO:
+    return build_excel(family=get_report_data(family=family))
 
-   
-    family = format_data({key: value for key, value in family.items() if family[key]})
 
-    workbook = Workbook()
-    worksheet = get_active_worksheet(wb=workbook)
+def get_excel_file(family: Dict) -> CachedReport:
+    """Returns the report file of the portrait, built only if no identical portrait was exported before."""
+    data = get_report_data(family=family)
+    return get_report_cache().get_or_create(data=data, build=lambda: build_excel(family=data))
 
-    write_data(worksheet=worksheet, family=family)
-    set_column_width(worksheet=worksheet, width=15)
 
-    workbook.save(filename=excel_name)
+def get_batch_excel(rows: Iterable[List[Any]]) -> io.BytesIO:
+    """Writes one family per row into a single sheet. The first row is the header.
+    Rows are appended as they arrive, so memory stays flat regardless of the batch size.
+    """
+    workbook = create_workbook()
+    worksheet = workbook.create_sheet()
 
-    return excel_name
+    rows = iter(rows)
+    header = next(rows, [])
+    set_column_width(worksheet=worksheet, column_cnt=len(header), width=COLUMN_WIDTH)
+    write_header(worksheet=worksheet, header=header)
+    for row in rows:
+        write_row(worksheet=worksheet, row=row)
 
+    return save_workbook(workbook=workbook)
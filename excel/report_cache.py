@@ -0,0 +1,108 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Optional
+
+from family.utils import Lazy
+
+
+DEFAULT_REPORT_CACHE_DIR = 'cache/reports'
+DEFAULT_REPORT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_REPORT_CACHE_MAX_AGE = 7 * 86400
+# part of every key, bump it when the layout of the report changes
+REPORT_VERSION = 1
+
+
+@dataclass
+class CachedReport:
+    path: str
+    key: str
+    created_at: float
+
+
+def get_report_key(data: Dict) -> str:
+    body = json.dumps([REPORT_VERSION, data], ensure_ascii=False, default=str)
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()
+
+
+class ReportCache:
+    """XLSX reports on disk, named after the hash of the formatted portrait they contain, so identical
+    portraits share one file. Files not downloaded for `max_age` seconds are dropped, and the least
+    recently downloaded ones go first once the directory grows over `max_bytes`.
+    The access time of a file is its last download, the modification time its creation.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_age: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.xlsx')
+
+    def get(self, key: str) -> Optional[CachedReport]:
+        path = self.get_path(key)
+        try:
+            stat = os.stat(path)
+            # set explicitly, the file system may be mounted with noatime
+            os.utime(path, (time.time(), stat.st_mtime))
+        except FileNotFoundError:
+            return None
+        return CachedReport(path=path, key=key, created_at=stat.st_mtime)
+
+    def get_or_create(self, data: Dict, build: Callable[[], io.BytesIO]) -> CachedReport:
+        key = get_report_key(data=data)
+        report = self.get(key)
+        if report is not None:
+            return report
+
+        path = self.get_path(key)
+        # written under a unique name and renamed, so other workers never see a half-written file
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(build().getbuffer())
+        os.replace(tmp_path, path)
+
+        self.evict(keep=path)
+        return CachedReport(path=path, key=key, created_at=os.stat(path).st_mtime)
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        now = time.time()
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.xlsx'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_atime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        # the report that is about to be sent counts towards the size, but is never removed
+        files = sorted(file for file in files if file[2] != keep)
+        for used_at, size, path in files:
+            if now - used_at <= self.max_age and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+_report_cache = Lazy(lambda: ReportCache(
+    directory=os.getenv('REPORT_CACHE_DIR', DEFAULT_REPORT_CACHE_DIR),
+    max_bytes=int(os.getenv('REPORT_CACHE_MAX_BYTES', DEFAULT_REPORT_CACHE_MAX_BYTES)),
+    max_age=float(os.getenv('REPORT_CACHE_MAX_AGE', DEFAULT_REPORT_CACHE_MAX_AGE))
+))
+
+
+def get_report_cache() -> ReportCache:
+    return _report_cache.get()
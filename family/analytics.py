@@ -0,0 +1,280 @@
+"""Columnar store of every profile fetched from the upstream, for aggregate reports without upstream calls.
+
+    python -m family.analytics --bins 20 --since 2024-01-01
+
+Appending needs only the standard library; the reports need numpy (pip install numpy).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import threading
+from array import array
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from family.custom_exceptions import AnalyticsUnavailable
+    from family.entities import Family, Recommendations, Risks
+    from family.utils import SOCIAL_STATUSES, Lazy
+except (ModuleNotFoundError, ImportError):
+    from custom_exceptions import AnalyticsUnavailable
+    from entities import Family, Recommendations, Risks
+    from utils import SOCIAL_STATUSES, Lazy
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ANALYTICS_DIR = 'cache/analytics'
+DEFAULT_HISTOGRAM_BINS = 10
+PERCENTILES = (10, 25, 50, 75, 90)
+INCOME_COLUMNS = ('per_capita_income', 'per_capita_income_asp')
+# one file per column, every value of a column has the same width, so a column is read with one np.fromfile;
+# the strings go through a dictionary and are stored as their index in it
+COLUMNS = {
+    'fetched_at': 'd',
+    'family_key': 'q',
+    'member_cnt': 'H',
+    'child_cnt': 'H',
+    'family_level': 'B',
+    'income': 'B',
+    'salary': 'd',
+    'social_payment': 'd',
+    'per_capita_income': 'd',
+    'total_income_asp': 'd',
+    'per_capita_income_asp': 'd',
+    'recommendations': 'B',
+    'risks': 'B',
+    # len(SOCIAL_STATUSES) counts per family
+    'social_status': 'H',
+}
+DICTIONARY_COLUMNS = ('family_level', 'income')
+
+
+def import_numpy() -> Any:
+    try:
+        import numpy
+    except ImportError:
+        raise AnalyticsUnavailable()
+    return numpy
+
+
+def get_family_key(iin: str, family: Family) -> int:
+    # a household looked up through different members is counted once
+    return min((int(member.iin) for member in family.members if member is not None), default=int(iin))
+
+
+def get_recommendation_mask(recommendations: Recommendations) -> int:
+    return sum(1 << i for i, name in enumerate(Recommendations.__slots__) if getattr(recommendations, name))
+
+
+def get_row_width(column: str) -> int:
+    return len(SOCIAL_STATUSES) if column == 'social_status' else 1
+
+
+class AnalyticsStore:
+    """Append-only column files shared by all gunicorn workers. Appends hold an exclusive file lock
+    and commit a row by raising the row count once every column has it; reads only use the committed rows,
+    and the next append cuts off whatever a failed one left behind. Reports count the latest row of every family.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, column: str) -> str:
+        return os.path.join(self.directory, f'{column}.bin')
+
+    @contextmanager
+    def _locked(self, exclusive: bool) -> Iterator[None]:
+        with self._lock, open(os.path.join(self.directory, '.lock'), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def _load_dictionaries(self) -> Dict[str, List[Optional[str]]]:
+        try:
+            with open(os.path.join(self.directory, 'dictionaries.json'), encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {column: [] for column in DICTIONARY_COLUMNS}
+
+    def _save_dictionaries(self, dictionaries: Dict[str, List[Optional[str]]]) -> None:
+        path = os.path.join(self.directory, 'dictionaries.json')
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(dictionaries, f, ensure_ascii=False)
+        os.replace(f'{path}.tmp', path)
+
+    def _count_rows(self) -> int:
+        try:
+            with open(os.path.join(self.directory, 'rows'), encoding='utf-8') as f:
+                return int(f.read())
+        except FileNotFoundError:
+            pass
+        # columns written before the row count was kept
+        rows = []
+        for column, typecode in COLUMNS.items():
+            try:
+                size = os.path.getsize(self.get_path(column))
+            except FileNotFoundError:
+                size = 0
+            rows.append(size // (array(typecode).itemsize * get_row_width(column)))
+        return min(rows)
+
+    def _save_row_count(self, rows: int) -> None:
+        path = os.path.join(self.directory, 'rows')
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            f.write(str(rows))
+        os.replace(f'{path}.tmp', path)
+
+    def append(self, iin: str, family: Family, fetched_at: float) -> None:
+        with self._locked(exclusive=True):
+            dictionaries = self._load_dictionaries()
+            codes = {}
+            for column in DICTIONARY_COLUMNS:
+                value = getattr(family, column)
+                if value not in dictionaries[column]:
+                    dictionaries[column].append(value)
+                    self._save_dictionaries(dictionaries=dictionaries)
+                codes[column] = dictionaries[column].index(value)
+
+            row = {
+                'fetched_at': [fetched_at],
+                'family_key': [get_family_key(iin=iin, family=family)],
+                'member_cnt': [family.member_cnt],
+                'child_cnt': [family.child_cnt],
+                'family_level': [codes['family_level']],
+                'income': [codes['income']],
+                'salary': [family.salary],
+                'social_payment': [family.social_payment],
+                'per_capita_income': [family.per_capita_income],
+                'total_income_asp': [family.total_income_asp],
+                'per_capita_income_asp': [family.per_capita_income_asp],
+                'recommendations': [get_recommendation_mask(recommendations=family.recommendations)],
+                'risks': [family.risks.mask],
+                'social_status': family.social_status,
+            }
+            # every value is converted before the first file is touched, so a value that does not fit
+            # its column fails the whole row instead of leaving the columns with different lengths
+            arrays = {column: array(typecode, row[column]) for column, typecode in COLUMNS.items()}
+            rows = self._count_rows()
+            for column, values in arrays.items():
+                with open(self.get_path(column), 'ab') as f:
+                    f.truncate(rows * values.itemsize * get_row_width(column))
+                    values.tofile(f)
+            self._save_row_count(rows=rows + 1)
+
+    def load(self, since: Optional[float] = None) -> Dict[str, Any]:
+        """Reads the latest row of every family into numpy arrays, `social_status` as a (families, statuses) matrix."""
+        np = import_numpy()
+        with self._locked(exclusive=False):
+            dictionaries = self._load_dictionaries()
+            rows = self._count_rows()
+            columns = {}
+            for column, typecode in COLUMNS.items():
+                try:
+                    columns[column] = np.fromfile(self.get_path(column), dtype=np.dtype(typecode), count=rows * get_row_width(column))
+                except FileNotFoundError:
+                    columns[column] = np.zeros(0, dtype=np.dtype(typecode))
+
+        columns['social_status'] = columns['social_status'].reshape(rows, len(SOCIAL_STATUSES))
+
+        # the last row of every family: np.unique returns the first occurrence, so it runs over the reversed keys
+        _, reversed_index = np.unique(columns['family_key'][::-1], return_index=True)
+        latest = np.sort(rows - 1 - reversed_index)
+        if since is not None:
+            latest = latest[columns['fetched_at'][latest] >= since]
+        columns = {column: values[latest] for column, values in columns.items()}
+        columns['dictionaries'] = dictionaries
+        return columns
+
+
+def get_distribution(np: Any, values: Any, bins: int) -> Dict:
+    if len(values) == 0:
+        return {'count': 0}
+    counts, edges = np.histogram(values, bins=bins)
+    return {
+        'count': int(len(values)),
+        'mean': round(float(values.mean()), 2),
+        'min': round(float(values.min()), 2),
+        'max': round(float(values.max()), 2),
+        'percentiles': {str(p): round(float(v), 2) for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))},
+        'histogram': {'edges': [round(float(edge), 2) for edge in edges], 'counts': counts.tolist()},
+    }
+
+
+def get_bit_frequencies(masks: Any, names: List[str]) -> Dict[str, int]:
+    return {name: int(((masks >> i) & 1).sum()) for i, name in enumerate(names)}
+
+
+def get_status_by_level(np: Any, levels: Any, statuses: Any, level_names: List[Optional[str]]) -> Dict[str, Dict[str, int]]:
+    # number of people with each social status, summed per family level in one pass
+    totals = np.zeros((len(level_names), statuses.shape[1]), dtype=np.int64)
+    np.add.at(totals, levels, statuses)
+    return {
+        str(level_name): {name: int(count) for name, count in zip(SOCIAL_STATUSES, totals[code]) if count}
+        for code, level_name in enumerate(level_names) if totals[code].any()
+    }
+
+
+def get_report(store: 'AnalyticsStore', bins: int = DEFAULT_HISTOGRAM_BINS, since: Optional[float] = None) -> Dict:
+    np = import_numpy()
+    columns = store.load(since=since)
+    return {
+        'families': int(len(columns['family_key'])),
+        **{column: get_distribution(np=np, values=columns[column], bins=bins) for column in INCOME_COLUMNS},
+        'risks': get_bit_frequencies(masks=columns['risks'], names=Risks.names),
+        'recommendations': get_bit_frequencies(masks=columns['recommendations'], names=Recommendations.names),
+        'social_status_by_family_level': get_status_by_level(
+            np=np, levels=columns['family_level'], statuses=columns['social_status'],
+            level_names=columns['dictionaries']['family_level']
+        ),
+    }
+
+
+_analytics_store = Lazy(lambda: AnalyticsStore(directory=os.getenv('ANALYTICS_DIR', DEFAULT_ANALYTICS_DIR)))
+
+
+def get_analytics_store() -> AnalyticsStore:
+    return _analytics_store.get()
+
+
+def record_family(iin: str, family: Family, fetched_at: float) -> None:
+    """Appends a fetched family in the background, the lookup does not wait for the disk.
+    Must be called on the process event loop. ANALYTICS_ENABLED=0 turns it off.
+    """
+    if os.getenv('ANALYTICS_ENABLED', '1').lower() in ('0', 'false', 'no'):
+        return
+
+    def log_error(future: asyncio.Future) -> None:
+        if future.exception() is not None:
+            logger.error(f'Could not record profile {iin} for analytics: {future.exception()!r}')
+
+    future = asyncio.get_running_loop().run_in_executor(None, get_analytics_store().append, iin, family, fetched_at)
+    future.add_done_callback(log_error)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Aggregates over all fetched family profiles')
+    parser.add_argument('--bins', type=int, default=DEFAULT_HISTOGRAM_BINS, help='histogram bins of the incomes')
+    parser.add_argument('--since', type=datetime.fromisoformat, help='only families fetched since this date')
+    args = parser.parse_args()
+
+    since = args.since.timestamp() if args.since else None
+    try:
+        report = get_report(store=get_analytics_store(), bins=args.bins, since=since)
+    except AnalyticsUnavailable as e:
+        parser.exit(1, f'{e.error_msg}\n')
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
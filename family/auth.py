@@ -0,0 +1,140 @@
+import asyncio
+import base64
+import json
+import os
+import time
+from typing import Any, Dict, Optional
+from urllib.parse import urlparse
+
+import httpx
+
+try:
+    from family.custom_exceptions import WrongPassword
+    from family.entities import User
+    from family.metrics import timed
+    from family.resilience import Race, Upstream, create_upstream, get_client_timeout, run_stage, use_http2
+    from family.utils import Lazy, get_env_vars, get_headers
+except (ModuleNotFoundError, ImportError):
+    from custom_exceptions import WrongPassword
+    from entities import User
+    from metrics import timed
+    from resilience import Race, Upstream, create_upstream, get_client_timeout, run_stage, use_http2
+    from utils import Lazy, get_env_vars, get_headers
+
+
+DEFAULT_TOKEN_TTL = 600
+REFRESH_MARGIN = 60
+
+
+def get_token_expiry(auth_data: Dict[str, Any], now: float) -> float:
+    """Returns the absolute expiry time of an /auth/login response.
+    Uses `expiresIn` if the upstream sends it, otherwise the `exp` claim of the JWT,
+    otherwise falls back to DEFAULT_TOKEN_TTL.
+    """
+    expires_in = auth_data.get('expiresIn')
+    if expires_in:
+        return now + float(expires_in)
+
+    token = auth_data.get('accessToken', '')
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload))['exp']
+        return float(exp)
+    except (IndexError, KeyError, TypeError, ValueError):
+        return now + float(os.getenv('TOKEN_TTL', DEFAULT_TOKEN_TTL))
+
+
+class TokenManager:
+    """Logs in once, caches the access token until shortly before it expires
+    and shares one pooled httpx.AsyncClient between all lookups of the worker.
+    Must only be used from the process event loop (see family.runtime).
+    """
+
+    def __init__(self, user: User, base_url: str, client: httpx.AsyncClient, upstream: Upstream, refresh_margin: float = REFRESH_MARGIN):
+        self.user = user
+        self.base_url = base_url
+        self.client = client
+        self.upstream = upstream
+        self.host = urlparse(base_url).netloc
+        self.refresh_margin = refresh_margin
+        self._token: Optional[str] = None
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def _login(self) -> None:
+        response = await self.upstream.send(host=self.host, send=lambda: self.client.post(
+            url=f'{self.base_url}/auth/login',
+            json={'username': self.user.username, 'password': self.user.password},
+            timeout=3
+        ))
+        try:
+            response.raise_for_status()
+        except httpx.HTTPStatusError:
+            raise WrongPassword
+        auth_data = response.json()
+        now = time.time()
+        self._token = auth_data['accessToken']
+        self._expires_at = get_token_expiry(auth_data=auth_data, now=now)
+
+    def _is_fresh(self) -> bool:
+        return self._token is not None and time.time() < self._expires_at - self.refresh_margin
+
+    async def get_token(self) -> str:
+        if self._is_fresh():
+            return self._token
+        async with self._lock:
+            if not self._is_fresh():
+                with timed('login'):
+                    await run_stage('login', self._login())
+            return self._token
+
+    def invalidate(self, token: str) -> None:
+        if self._token == token:
+            self._token = None
+            self._expires_at = 0.0
+
+    async def _send(self, method: str, url: str, token: str, hedge: Optional[str], race: Optional[Race],
+                    upstream: Optional[Upstream], **kwargs: Any) -> httpx.Response:
+        return await (upstream or self.upstream).send(
+            host=self.host,
+            send=lambda: self.client.request(method, url, headers={'Authorization': f'Bearer {token}'}, **kwargs),
+            hedge=hedge,
+            race=race
+        )
+
+    async def request(self, method: str, url: str, hedge: Optional[str] = None, race: Optional[Race] = None,
+                      upstream: Optional[Upstream] = None, **kwargs: Any) -> httpx.Response:
+        """`upstream` replaces the shared limiter and circuit breaker of the lookups, e.g. for background jobs."""
+        token = await self.get_token()
+        response = await self._send(method, url, token, hedge, race, upstream, **kwargs)
+        if response.status_code == 401:
+            self.invalidate(token=token)
+            token = await self.get_token()
+            response = await self._send(method, url, token, hedge, race, upstream, **kwargs)
+        return response
+
+    async def post(self, url: str, hedge: Optional[str] = None, race: Optional[Race] = None,
+                   upstream: Optional[Upstream] = None, **kwargs: Any) -> httpx.Response:
+        return await self.request('POST', url, hedge=hedge, race=race, upstream=upstream, **kwargs)
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+def create_token_manager() -> TokenManager:
+    base_url, username, password = get_env_vars()
+    client = httpx.AsyncClient(headers=get_headers(), timeout=get_client_timeout(), http2=use_http2())
+    return TokenManager(
+        user=User(username=username, password=password), base_url=base_url, client=client, upstream=create_upstream()
+    )
+
+
+_token_manager = Lazy(create_token_manager)
+
+
+def get_token_manager() -> TokenManager:
+    """Returns the token manager of the current process, creating it on first use.
+    Forked gunicorn workers get their own, so they never share a connection pool.
+    """
+    return _token_manager.get()
@@ -0,0 +1,193 @@
+import argparse
+import asyncio
+import csv
+import functools
+import io
+import logging
+import os
+import re
+import sys
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import httpx
+
+try:
+    from family.custom_exceptions import FamilyNotFound, WrongIIN, WrongPassword, IINNotInSections, NoVPNConnection
+    from family.entities import Family
+    from family.family import get_family_data_async
+    from family.runtime import run_iter
+except (ModuleNotFoundError, ImportError):
+    from custom_exceptions import FamilyNotFound, WrongIIN, WrongPassword, IINNotInSections, NoVPNConnection
+    from entities import Family
+    from family import get_family_data_async
+    from runtime import run_iter
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_CONCURRENCY = 8
+MAX_BATCH_CONCURRENCY = 32
+LOOKUP_FAILED_MSG = 'Не удалось получить данные семьи'
+
+
+@dataclass
+class BatchResult:
+    iin: str
+    family: Optional[Dict] = None
+    error: Optional[str] = None
+
+
+def get_batch_concurrency(concurrency: Optional[int] = None) -> int:
+    if concurrency is None:
+        concurrency = int(os.getenv('BATCH_CONCURRENCY', DEFAULT_BATCH_CONCURRENCY))
+    return max(1, min(concurrency, int(os.getenv('BATCH_MAX_CONCURRENCY', MAX_BATCH_CONCURRENCY))))
+
+
+def parse_iins(text: str) -> List[str]:
+    """Takes the first column of a CSV file or a plain list with one IIN per line.
+    A first line without digits is treated as a header, duplicates are dropped.
+    """
+    iins = []
+    for i, line in enumerate(text.splitlines()):
+        cell = re.split(r'[,;\t]', line, maxsplit=1)[0].strip().strip('"\'\ufeff')
+        if not cell or (i == 0 and not any(c.isdigit() for c in cell)):
+            continue
+        iins.append(cell)
+    return list(dict.fromkeys(iins))
+
+
+async def lookup_family(iin: str) -> BatchResult:
+    try:
+        return BatchResult(iin=iin, family=await get_family_data_async(iin=iin))
+    except (FamilyNotFound, WrongIIN, WrongPassword, IINNotInSections, NoVPNConnection) as e:
+        return BatchResult(iin=iin, error=e.error_msg)
+    except (httpx.ConnectTimeout, httpx.ReadTimeout, httpx.ConnectError):
+        return BatchResult(iin=iin, error=NoVPNConnection().error_msg)
+    except Exception:
+        # one broken profile gets an error row, it must not cancel the lookups of the other IINs
+        logger.exception(f'Lookup of {iin} failed')
+        return BatchResult(iin=iin, error=LOOKUP_FAILED_MSG)
+
+
+async def lookup_families(callback: Callable[[BatchResult], Any], iins: Iterable[str], concurrency: int) -> None:
+    """Looks up every IIN with at most `concurrency` lookups in flight
+    and passes each result to `callback` as soon as it is ready.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks = set()
+
+    async def worker(iin: str) -> None:
+        try:
+            callback(await lookup_family(iin=iin))
+        finally:
+            semaphore.release()
+
+    try:
+        for iin in iins:
+            await semaphore.acquire()
+            task = asyncio.ensure_future(worker(iin=iin))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def iter_family_data(iins: Iterable[str], concurrency: Optional[int] = None) -> Iterator[BatchResult]:
+    """Runs lookup_families on the process event loop and yields the results in completion order."""
+    return run_iter(functools.partial(lookup_families, iins=iins, concurrency=get_batch_concurrency(concurrency)))
+
+
+def get_batch_columns() -> List[Tuple[str, Optional[str]]]:
+    columns = []
+    for section, value in Family().to_dict().items():
+        if isinstance(value, dict) and value:
+            columns.extend((section, key) for key in value)
+        else:
+            columns.append((section, None))
+    return columns
+
+
+def get_batch_header() -> List[str]:
+    return ['ИИН', 'Ошибка'] + [key or section for section, key in get_batch_columns()]
+
+
+def format_value(value: Any) -> Any:
+    if isinstance(value, list):
+        return '; '.join(' '.join(el.values()) if isinstance(el, dict) else str(el) for el in value)
+    if isinstance(value, dict):
+        return '; '.join(f'{key}: {val}' for key, val in value.items())
+    return value
+
+
+def get_batch_row(result: BatchResult, columns: List[Tuple[str, Optional[str]]]) -> List[Any]:
+    row = [result.iin, result.error or '']
+    for section, key in columns:
+        if result.family is None:
+            row.append('')
+        elif key is None:
+            row.append(format_value(result.family[section]))
+        else:
+            row.append(result.family[section][key])
+    return row
+
+
+def iter_batch_rows(results: Iterable[BatchResult]) -> Iterator[List[Any]]:
+    columns = get_batch_columns()
+    yield get_batch_header()
+    for result in results:
+        yield get_batch_row(result=result, columns=columns)
+
+
+def iter_csv(rows: Iterable[List[Any]]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # BOM so that Excel opens the cyrillic headers as UTF-8
+    yield '\ufeff'
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Bulk lookup of family profiles')
+    parser.add_argument('input', help='CSV or text file with one IIN per line, "-" for stdin')
+    parser.add_argument('-o', '--output', help='output file, stdout by default (csv only)')
+    parser.add_argument('-f', '--format', choices=['csv', 'xlsx'], default=None)
+    parser.add_argument('-c', '--concurrency', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.input == '-':
+        text = sys.stdin.read()
+    else:
+        with open(args.input, encoding='utf-8-sig') as f:
+            text = f.read()
+
+    output_format = args.format or ('xlsx' if args.output and args.output.endswith('.xlsx') else 'csv')
+    rows = iter_batch_rows(iter_family_data(iins=parse_iins(text=text), concurrency=args.concurrency))
+
+    if output_format == 'xlsx':
+        from excel.excel import get_batch_excel
+
+        if not args.output:
+            parser.error('--output is required for xlsx')
+        with open(args.output, 'wb') as f:
+            f.write(get_batch_excel(rows=rows).getvalue())
+        return
+
+    output = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    try:
+        for chunk in iter_csv(rows=rows):
+            output.write(chunk)
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
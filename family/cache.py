@@ -0,0 +1,235 @@
+import json
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+try:
+    from family.singleflight import SingleFlight
+    from family.sqlite_store import SQLiteStore
+    from family.utils import Lazy
+except (ModuleNotFoundError, ImportError):
+    from singleflight import SingleFlight
+    from sqlite_store import SQLiteStore
+    from utils import Lazy
+
+
+DEFAULT_CACHE_PATH = 'cache/profiles.sqlite3'
+DEFAULT_CACHE_TTL = 43200
+DEFAULT_CACHE_STALE_TTL = 86400
+DEFAULT_CACHE_MAX_ENTRIES = 10000
+REVALIDATE_TIMEOUT = 60
+DEFAULT_LOOKUP_LEASE_TIMEOUT = 60
+DEFAULT_PERSON_CACHE_TTL = 3600
+DEFAULT_PERSON_CACHE_MAX_ENTRIES = 50000
+
+
+@dataclass
+class CachedProfile:
+    iin: str
+    profile: Dict
+    fetched_at: float
+    is_stale: bool
+
+
+@dataclass
+class LookupState:
+    lease_until: float
+    finished_at: float
+    error: Optional[str]
+
+
+class ProfileCache(SQLiteStore):
+    """Family profiles keyed by IIN, stored in SQLite so all gunicorn workers share them.
+    Entries younger than `ttl` are fresh, entries younger than `ttl + stale_ttl` are served
+    as stale while one worker revalidates them, older entries are dropped.
+    The lookups table holds short leases that let one worker fetch an IIN while the others wait for it.
+    The members table maps every member of a fetched family to the IIN its profile is stored under,
+    in the order of the upstream member list.
+    """
+
+    def __init__(self, path: str, ttl: float, stale_ttl: float, max_entries: int, lease_timeout: float = DEFAULT_LOOKUP_LEASE_TIMEOUT):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self.lease_timeout = lease_timeout
+        super().__init__(path=path)
+
+    def create_tables(self, connection: sqlite3.Connection) -> None:
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS profiles ('
+            'iin TEXT PRIMARY KEY, profile TEXT NOT NULL, fetched_at REAL NOT NULL, refreshing_until REAL NOT NULL DEFAULT 0)'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS profiles_fetched_at ON profiles (fetched_at)')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS lookups ('
+            'iin TEXT PRIMARY KEY, lease_until REAL NOT NULL, finished_at REAL NOT NULL DEFAULT 0, error TEXT)'
+        )
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS members (iin TEXT PRIMARY KEY, household TEXT NOT NULL, position INTEGER NOT NULL)'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS members_household ON members (household)')
+
+    def get(self, iin: str) -> Optional[CachedProfile]:
+        row = self._connect().execute('SELECT profile, fetched_at FROM profiles WHERE iin = ?', (iin,)).fetchone()
+        if row is None:
+            return None
+
+        profile, fetched_at = row
+        age = time.time() - fetched_at
+        if age > self.ttl + self.stale_ttl:
+            return None
+        return CachedProfile(iin=iin, profile=json.loads(profile), fetched_at=fetched_at, is_stale=age > self.ttl)
+
+    def set(self, iin: str, profile: Dict) -> None:
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO profiles (iin, profile, fetched_at, refreshing_until) VALUES (?, ?, ?, 0)',
+                (iin, json.dumps(profile, ensure_ascii=False), now)
+            )
+            self._evict(connection=connection, now=now)
+
+    def delete(self, iin: str) -> None:
+        with self._connect() as connection:
+            connection.execute('DELETE FROM profiles WHERE iin = ?', (iin,))
+
+    def set_members(self, household: str, member_iins: List[str]) -> None:
+        with self._connect() as connection:
+            connection.execute('DELETE FROM members WHERE household = ?', (household,))
+            connection.executemany(
+                'INSERT OR REPLACE INTO members (iin, household, position) VALUES (?, ?, ?)',
+                [(member_iin, household, position) for position, member_iin in enumerate(member_iins)]
+            )
+
+    def get_household(self, iin: str) -> Optional[Tuple[str, List[str]]]:
+        """Returns the IIN the family of a member is stored under and the IINs of all its members."""
+        connection = self._connect()
+        row = connection.execute('SELECT household FROM members WHERE iin = ?', (iin,)).fetchone()
+        if row is None:
+            return None
+        household = row[0]
+        rows = connection.execute('SELECT iin FROM members WHERE household = ? ORDER BY position', (household,)).fetchall()
+        return household, [member_iin for member_iin, in rows]
+
+    def claim_revalidation(self, iin: str) -> bool:
+        """Marks a stale entry as being refreshed. Returns False if another worker already does it."""
+        now = time.time()
+        with self._connect() as connection:
+            cursor = connection.execute(
+                'UPDATE profiles SET refreshing_until = ? WHERE iin = ? AND refreshing_until < ?',
+                (now + REVALIDATE_TIMEOUT, iin, now)
+            )
+        return cursor.rowcount == 1
+
+    def release_revalidation(self, iin: str) -> None:
+        with self._connect() as connection:
+            connection.execute('UPDATE profiles SET refreshing_until = 0 WHERE iin = ?', (iin,))
+
+    def acquire_lookup(self, iin: str) -> bool:
+        """Takes the lease for fetching an IIN. Returns False while another worker holds it."""
+        now = time.time()
+        with self._connect() as connection:
+            cursor = connection.execute(
+                'INSERT INTO lookups (iin, lease_until, finished_at, error) VALUES (?, ?, 0, NULL) '
+                'ON CONFLICT (iin) DO UPDATE SET lease_until = excluded.lease_until, finished_at = 0, error = NULL '
+                'WHERE lookups.lease_until < ?',
+                (iin, now + self.lease_timeout, now)
+            )
+        return cursor.rowcount == 1
+
+    def release_lookup(self, iin: str, error: Optional[str] = None) -> None:
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute('UPDATE lookups SET lease_until = 0, finished_at = ?, error = ? WHERE iin = ?', (now, error, iin))
+            connection.execute('DELETE FROM lookups WHERE lease_until = 0 AND finished_at < ?', (now - self.lease_timeout,))
+
+    def get_lookup(self, iin: str) -> Optional[LookupState]:
+        row = self._connect().execute('SELECT lease_until, finished_at, error FROM lookups WHERE iin = ?', (iin,)).fetchone()
+        if row is None:
+            return None
+        return LookupState(*row)
+
+    def _evict(self, connection: sqlite3.Connection, now: float) -> None:
+        evicted = connection.execute('DELETE FROM profiles WHERE fetched_at < ?', (now - self.ttl - self.stale_ttl,)).rowcount
+        evicted += connection.execute(
+            'DELETE FROM profiles WHERE iin IN (SELECT iin FROM profiles ORDER BY fetched_at DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        ).rowcount
+        if evicted:
+            connection.execute('DELETE FROM members WHERE household NOT IN (SELECT iin FROM profiles)')
+
+
+class PersonStatusCache:
+    """Social statuses of single family members, kept in memory of the worker with TTL and LRU eviction.
+    Concurrent misses for the same member IIN share one upstream call.
+    Only used from the process event loop, so no locking is needed.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: Dict[str, Tuple[List[str], float]] = OrderedDict()
+        self._single_flight = SingleFlight()
+
+    def get(self, iin: str) -> Optional[List[str]]:
+        entry = self._entries.get(iin)
+        if entry is None:
+            return None
+
+        statuses, fetched_at = entry
+        if time.monotonic() - fetched_at > self.ttl:
+            del self._entries[iin]
+            return None
+        self._entries.move_to_end(iin)
+        return statuses
+
+    def set(self, iin: str, statuses: List[str]) -> None:
+        self._entries[iin] = (statuses, time.monotonic())
+        self._entries.move_to_end(iin)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get_or_fetch(self, iin: str, fetch: Callable[[], Awaitable[List[str]]]) -> List[str]:
+        statuses = self.get(iin)
+        if statuses is not None:
+            return statuses
+
+        async def fetch_and_store() -> List[str]:
+            result = await fetch()
+            self.set(iin, result)
+            return result
+
+        return await self._single_flight.do(key=iin, func=fetch_and_store)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_profile_cache = Lazy(lambda: ProfileCache(
+    path=os.getenv('PROFILE_CACHE_PATH', DEFAULT_CACHE_PATH),
+    ttl=float(os.getenv('PROFILE_CACHE_TTL', DEFAULT_CACHE_TTL)),
+    stale_ttl=float(os.getenv('PROFILE_CACHE_STALE_TTL', DEFAULT_CACHE_STALE_TTL)),
+    max_entries=int(os.getenv('PROFILE_CACHE_MAX_ENTRIES', DEFAULT_CACHE_MAX_ENTRIES)),
+    lease_timeout=float(os.getenv('LOOKUP_LEASE_TIMEOUT', DEFAULT_LOOKUP_LEASE_TIMEOUT))
+))
+
+
+def get_profile_cache() -> ProfileCache:
+    return _profile_cache.get()
+
+
+_person_status_cache: Optional[PersonStatusCache] = None
+
+
+def get_person_status_cache() -> PersonStatusCache:
+    global _person_status_cache
+
+    if _person_status_cache is None:
+        _person_status_cache = PersonStatusCache(
+            ttl=float(os.getenv('PERSON_CACHE_TTL', DEFAULT_PERSON_CACHE_TTL)),
+            max_entries=int(os.getenv('PERSON_CACHE_MAX_ENTRIES', DEFAULT_PERSON_CACHE_MAX_ENTRIES))
+        )
+    return _person_status_cache
@@ -20,3 +20,15 @@ class IINNotInSections(Exception):
     def __init__(self):
         super().__init__('IIN not in sections')
         self.error_msg = 'ИИН не найден ни в одном из разделов "Нуждающиеся в мерах"'
+
+
+class NoVPNConnection(Exception):
+    def __init__(self):
+        super().__init__('No VPN connection')
+        self.error_msg = 'Нет подключения к VPN на сервере. Свяжитесь с администраторами'
+
+
+class AnalyticsUnavailable(Exception):
+    def __init__(self):
+        super().__init__('numpy is not installed')
+        self.error_msg = 'Аналитика недоступна: на сервере не установлен пакет numpy'
@@ -1,10 +1,11 @@
-from dataclasses import dataclass, field, fields, asdict
+from array import array
+from dataclasses import dataclass
 from typing import List, Dict
 
 try:
-    from family.utils import get_social_status_dict
+    from family.utils import RISK_INDEX, SOCIAL_STATUSES, SOCIAL_STATUS_INDEX
 except (ModuleNotFoundError, ImportError):
-    from utils import get_social_status_dict
+    from utils import RISK_INDEX, SOCIAL_STATUSES, SOCIAL_STATUS_INDEX
 
 
 @dataclass
@@ -13,80 +14,105 @@ class User:
     password: str
 
 
-@dataclass
 class Member:
-    iin: str
-    full_name: str
+    __slots__ = ('iin', 'full_name')
 
-    def __post_init__(self):
-        self.full_name = ' '.join([name.capitalize() for name in self.full_name.split(' ')])
+    def __init__(self, iin: str, full_name: str):
+        self.iin = iin
+        self.full_name = ' '.join([name.capitalize() for name in full_name.split(' ')])
 
     def to_dict(self) -> Dict[str, str]:
-        return {'ИИН': self.iin, 'ФИО': self.full_name} 
+        return {'ИИН': self.iin, 'ФИО': self.full_name}
 
 
-@dataclass
 class Risks:
-    income: str = None
-    credit: str = None
-    medical_attachment: str = None
-    dispensary: str = None
-    health_insurance: str = None
-    preschool: str = None
-    school: str = None
-
-    def to_dict(self):
-        names = [
-            'Уровень дохода ниже ЧБ',
-            'Семья имеет задолженность по кредиту больше 90 дней',
-            'Член семьи не имеет прикрепление к медицинской организации',
-            'Член семьи состоит на диспансерном учете',
-            'Член семьи не имеет обязательное социальное медицинское страхование',
-            'Дети не посещают дошкольные организации',
-            'Дети не посещают школы'
-        ]
-        return [name for risk, name in zip(fields(self), names) if getattr(self, risk.name)]
+    """Risks of a family as a bitmask, bit i is set for the i-th letter of RISK_CODES found in `riskDetail`."""
+
+    __slots__ = ('mask',)
+
+    names = [
+        'Уровень дохода ниже ЧБ',
+        'Семья имеет задолженность по кредиту больше 90 дней',
+        'Член семьи не имеет прикрепление к медицинской организации',
+        'Член семьи состоит на диспансерном учете',
+        'Член семьи не имеет обязательное социальное медицинское страхование',
+        'Дети не посещают дошкольные организации',
+        'Дети не посещают школы'
+    ]
+
+    def __init__(self, mask: int = 0):
+        self.mask = mask
+
+    @classmethod
+    def from_detail(cls, risk_detail: str) -> 'Risks':
+        mask = 0
+        for detail in risk_detail:
+            if detail == 'N':
+                continue
+            mask |= 1 << RISK_INDEX[detail]
+        return cls(mask=mask)
+
+    def to_dict(self) -> List[str]:
+        return [name for i, name in enumerate(self.names) if self.mask >> i & 1]
 
 
-@dataclass
 class Recommendations:
-    need_asp: bool = False
-    need_edu: bool = False
-    need_med: bool = False
-    need_emp: bool = False
-    need_nedv: bool = False
+    __slots__ = ('need_asp', 'need_edu', 'need_med', 'need_emp', 'need_nedv')
+
+    names = ['АСП', 'Образование', 'Медицина', 'Трудоустройство', 'Жилье']
+
+    def __init__(self):
+        self.need_asp = False
+        self.need_edu = False
+        self.need_med = False
+        self.need_emp = False
+        self.need_nedv = False
 
     def to_dict(self) -> List[str]:
-        names = ['АСП', 'Образование', 'Медицина', 'Трудоустройство', 'Жилье']
-        return [name for recommendation, name in zip(fields(self), names) if getattr(self, recommendation.name)]
+        return [name for recommendation, name in zip(self.__slots__, self.names) if getattr(self, recommendation)]
 
 
-@dataclass
 class Assets:
-    land_cnt: int = 0
-    emp_cnt: int = 0
-    soc_pay_recipient_cnt: int = 0
-    nedv_cnt: int = 0
-    transport_cnt: int = 0
+    __slots__ = ('land_cnt', 'emp_cnt', 'soc_pay_recipient_cnt', 'nedv_cnt', 'transport_cnt')
+
+    def __init__(self):
+        self.land_cnt = 0
+        self.emp_cnt = 0
+        self.soc_pay_recipient_cnt = 0
+        self.nedv_cnt = 0
+        self.transport_cnt = 0
 
 
-@dataclass
 class Family:
-    members: List[Member] = field(default_factory=list)
-    member_cnt: int = 0
-    child_cnt: int = 0
-    family_level: str = None
-    address: str = None
-    salary: int = 0
-    social_payment: int = 0
-    per_capita_income: int = 0
-    total_income_asp: int = 0
-    per_capita_income_asp: int = 0
-    income: str = None
-    recommendations: Recommendations = Recommendations()
-    assets: Assets = Assets()
-    risks: Risks = Risks()
-    social_status: Dict[str, int] = field(default_factory=get_social_status_dict)
+    """Every instance owns its nested objects, so concurrent lookups never share state.
+    Social statuses are counted in an array indexed by position in SOCIAL_STATUSES.
+    """
+
+    __slots__ = (
+        'members', 'member_cnt', 'child_cnt', 'family_level', 'address',
+        'salary', 'social_payment', 'per_capita_income', 'total_income_asp', 'per_capita_income_asp', 'income',
+        'recommendations', 'assets', 'risks', 'social_status'
+    )
+
+    def __init__(self):
+        self.members: List[Member] = []
+        self.member_cnt = 0
+        self.child_cnt = 0
+        self.family_level: str = None
+        self.address: str = None
+        self.salary = 0
+        self.social_payment = 0
+        self.per_capita_income = 0
+        self.total_income_asp = 0
+        self.per_capita_income_asp = 0
+        self.income: str = None
+        self.recommendations = Recommendations()
+        self.assets = Assets()
+        self.risks = Risks()
+        self.social_status = array('H', bytes(2 * len(SOCIAL_STATUSES)))
+
+    def add_social_status(self, status_name: str) -> None:
+        self.social_status[SOCIAL_STATUS_INDEX[status_name]] += 1
 
     def to_dict(self) -> Dict:
         return {
@@ -114,5 +140,7 @@ class Family:
                 'Транспорт': self.assets.transport_cnt
                 },
             'Риски': self.risks.to_dict(),
-            'Социальные статусы (кол-во человек)': {key: value for key, value in self.social_status.items() if value > 0},
+            'Социальные статусы (кол-во человек)': {
+                name: value for name, value in zip(SOCIAL_STATUSES, self.social_status) if value > 0
+            },
         }
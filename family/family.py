@@ -1,35 +1,60 @@
 import asyncio
+import functools
 import json
+import logging
+import os
 import time
-from typing import Any, Dict, List
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 import httpx
 
 try:
-    from family.custom_exceptions import FamilyNotFound, WrongIIN, IINNotInSections, WrongPassword
-    from family.utils import get_env_vars, get_headers, is_valid_iin, get_risk_dict
-    from family.entities import User, Family, Member, Risks
+    from family.analytics import record_family
+    from family.auth import TokenManager, get_token_manager
+    from family.cache import CachedProfile, get_person_status_cache, get_profile_cache
+    from family.metrics import timed
+    from family.resilience import Race, run_stage
+    from family.runtime import run_blocking, run_iter, run_sync, start_task
+    from family.section_index import get_section_index, start_section_sync
+    from family.sections import section_stats
+    from family.singleflight import SingleFlight
+    from family.custom_exceptions import FamilyNotFound, WrongIIN, WrongPassword, IINNotInSections, NoVPNConnection
+    from family.utils import is_valid_iin
+    from family.entities import Family, Member, Risks
 except (ModuleNotFoundError, ImportError):
-    from custom_exceptions import FamilyNotFound, WrongIIN, IINNotInSections, WrongPassword
-    from utils import get_env_vars, get_headers, is_valid_iin, get_risk_dict
-    from entities import User, Family, Member, Risks
-
-
-def get_token(user: User, base_url: str, client: httpx.Client) -> Dict[Any, Any]:
-    response = client.post(
-        url=f'{base_url}/auth/login',
-        json={'username': user.username, 'password': user.password},
-        timeout=3
-    )
-    try:
-        response.raise_for_status()
-    except httpx.HTTPStatusError:
-        raise WrongPassword
-    return response.json()
-
-
-def get_data(client: httpx.Client, api_url: str, iin: str) -> Dict:
-    response = client.post(url=api_url, json={'iin': iin})
+    from analytics import record_family
+    from auth import TokenManager, get_token_manager
+    from cache import CachedProfile, get_person_status_cache, get_profile_cache
+    from metrics import timed
+    from resilience import Race, run_stage
+    from runtime import run_blocking, run_iter, run_sync, start_task
+    from section_index import get_section_index, start_section_sync
+    from sections import section_stats
+    from singleflight import SingleFlight
+    from custom_exceptions import FamilyNotFound, WrongIIN, WrongPassword, IINNotInSections, NoVPNConnection
+    from utils import is_valid_iin
+    from entities import Family, Member, Risks
+
+
+logger = logging.getLogger(__name__)
+
+LOOKUP_POLL_INTERVAL = 0.05
+# sections probed right away; the others follow once these all missed or after DEFAULT_SECTION_PROBE_DELAY
+DEFAULT_SECTION_PROBE_FIRST = 3
+DEFAULT_SECTION_PROBE_DELAY = 0.1
+# errors that a lookup in one worker hands over to the workers waiting for the same IIN
+LOOKUP_ERRORS = {error.__name__: error for error in (FamilyNotFound, IINNotInSections, WrongPassword, NoVPNConnection)}
+
+_revalidations: Set[asyncio.Task] = set()
+_lookups = SingleFlight()
+
+# receives the progress events of a lookup: ('sections', {}) once the IIN passed the section check
+# and ('family', profile) with the profile before the social statuses of the members are known
+Progress = Callable[[str, Dict], None]
+
+
+async def get_data(token_manager: TokenManager, api_url: str, iin: str, hedge: Optional[str] = None) -> Dict:
+    response = await token_manager.post(url=api_url, hedge=hedge, json={'iin': iin})
     return response.json()
 
 
@@ -48,12 +73,44 @@ def get_member_data(family_data: Dict, iin: str) -> List[Member]:
     return members
 
 
+def select_member(profile: Dict, iin: str, member_iins: List[str]) -> Optional[Dict]:
+    """Re-orders the members of a stored profile as get_member_data would for `iin`: the selected member
+    first, the others in the order of the upstream list. Returns None if `iin` is not in the profile.
+    """
+    positions = {member_iin: position for position, member_iin in enumerate(member_iins)}
+    members = sorted(profile['Члены семьи'], key=lambda member: positions.get(member['ИИН'], len(positions)))
+    selected = [member for member in members if member['ИИН'] == iin]
+    if not selected:
+        return None
+    return {**profile, 'Члены семьи': selected + [member for member in members if member['ИИН'] != iin]}
+
+
 def family_exists(family_data: Dict) -> bool:
     return bool(family_data['family'])
 
 
-async def is_family_in_required_section(client: httpx.Client, base_url: str, iin: str) -> bool:
-    sections = [123, 120, 132, 131, 122, 121, 101, 130, 125, 126, 134, 124, 100, 93, 127]
+async def probe_section(token_manager: TokenManager, api_url: str, payload: Dict, section: int, race: Race) -> bool:
+    response = await token_manager.post(url=api_url, hedge='sections', race=race, json={**payload, 'countid': section})
+    hit = response.json()['total'] > 0
+    section_stats.record(section=section, hit=hit)
+    if hit:
+        await run_blocking(get_section_index().add, section, [payload['iin']], time.time())
+    return hit
+
+
+async def cancel_pending(tasks: List[asyncio.Future]) -> None:
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def is_family_in_required_section(token_manager: TokenManager, base_url: str, iin: str) -> bool:
+    # members of the synced sections are answered locally,
+    # only IINs missing from the index are probed live
+    start_section_sync()
+    if await run_blocking(get_section_index().contains, iin):
+        return True
+
     api_url = f'{base_url}/api/workspace/stat/page'
     payload = {
         'regionid': None,
@@ -64,67 +121,114 @@ async def is_family_in_required_section(client: httpx.Client, base_url: str, iin
         'size': 1
     }
 
-    client.headers['Content-Type'] = 'application/json'
-    async with httpx.AsyncClient(headers=client.headers, timeout=None) as async_client:
-        tasks = []
-        for section in sections:
-            payload['countid'] = section
-            tasks.append(async_client.post(url=api_url, json=payload))
-        responses = await asyncio.gather(*tasks)
-    return any(response.json()['total'] > 0 for response in responses)
+    # the sections with the highest observed hit rate are probed first, the others only once those
+    # all missed or after a short delay, and the check returns as soon as any section reports a hit
+    order = section_stats.get_order()
+    first = int(os.getenv('SECTION_PROBE_FIRST', DEFAULT_SECTION_PROBE_FIRST))
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + float(os.getenv('SECTION_PROBE_DELAY', DEFAULT_SECTION_PROBE_DELAY))
+    race = Race()
+
+    def probe(sections: List[int]) -> List[asyncio.Future]:
+        return [
+            asyncio.ensure_future(probe_section(
+                token_manager=token_manager, api_url=api_url, payload=payload, section=section, race=race
+            ))
+            for section in sections
+        ]
+
+    tasks = probe(order[:first])
+    waiting = order[first:]
+    pending = set(tasks)
+    try:
+        while pending or waiting:
+            if waiting and (not pending or loop.time() >= deadline):
+                started = probe(waiting)
+                tasks.extend(started)
+                pending.update(started)
+                waiting = []
+            timeout = max(0.0, deadline - loop.time()) if waiting else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.result():
+                    race.finish()
+                    return True
+        return False
+    finally:
+        await cancel_pending(tasks=tasks)
 
 
-async def get_person_details(family: Family, async_client: httpx.AsyncClient, base_url: str) -> List[Dict]:
-    results = []
-    api_url = f'{base_url}/api/card/getPersonDetailsDTOByIin'
-    tasks = [async_client.post(url=api_url, json={'iin': member.iin}) for member in family.members]
-    responses = await asyncio.gather(*tasks)
-    for response in responses:
-        results.append(response.json())
-    return results
+def get_statuses(person_detail: Dict) -> List[str]:
+    return [person_source['status']['nameRu'] for person_source in person_detail['personSourceList']]
 
 
-async def update_social_status(family: Family, client: httpx.Client, base_url: str) -> None:
-    async with httpx.AsyncClient(headers=client.headers, timeout=None) as async_client:
-        person_details = await get_person_details(async_client=async_client, family=family, base_url=base_url)
+async def get_person_statuses(token_manager: TokenManager, api_url: str, iin: str) -> List[str]:
+    person_detail = await get_data(token_manager=token_manager, api_url=api_url, iin=iin, hedge='person_details')
+    return get_statuses(person_detail=person_detail)
 
-    social_status = family.social_status
-    for person_detail in person_details:
-        for person_source in person_detail['personSourceList']:
-            status_name = person_source['status']['nameRu']
-            social_status[status_name] += 1
+
+async def get_person_details(member_iins: List[str], token_manager: TokenManager, base_url: str) -> List[List[str]]:
+    api_url = f'{base_url}/api/card/getPersonDetailsDTOByIin'
+    person_status_cache = get_person_status_cache()
+    tasks = [
+        person_status_cache.get_or_fetch(
+            iin=member_iin,
+            fetch=functools.partial(get_person_statuses, token_manager=token_manager, api_url=api_url, iin=member_iin)
+        )
+        for member_iin in member_iins
+    ]
+    return list(await asyncio.gather(*tasks))
+
+
+def update_social_status(family: Family, person_details: List[List[str]]) -> None:
+    for statuses in person_details:
+        for status_name in statuses:
+            family.add_social_status(status_name=status_name)
+
+
+async def fetch_family(token_manager: TokenManager, base_url: str, iin: str,
+                       family_info: Optional[asyncio.Future] = None) -> Tuple[Dict, List[List[str]]]:
+    with timed('family_info'):
+        family_data = await run_stage('family_info', get_data(
+            token_manager=token_manager, api_url=f'{base_url}/api/card/familyInfo', iin=iin
+        ))
+    if family_info is not None:
+        family_info.set_result(family_data)
+    if not family_exists(family_data=family_data):
+        return family_data, []
+
+    member_iins = [member['iin'] for member in family_data['familyMemberList']]
+    # every member is mapped to this lookup, so relatives are served from the profile it stores
+    members_stored = asyncio.ensure_future(run_blocking(get_profile_cache().set_members, iin, member_iins))
+    with timed('person_details'):
+        person_details = await run_stage('person_details', get_person_details(
+            member_iins=member_iins, token_manager=token_manager, base_url=base_url
+        ))
+    await members_stored
+    return family_data, person_details
 
 
 def get_risks(risk_detail: str) -> Risks:
-    risk_dict = get_risk_dict()
-    risks = Risks()
-    for detail in risk_detail:
-        if detail == 'N':
-            continue
-        risk = risk_dict[detail]
-        setattr(risks, risk['key'], risk['value'])
-    return risks
+    return Risks.from_detail(risk_detail=risk_detail)
 
 
 def get_value(val) -> int:
     return val if val is not None else 0
 
 
-def get_family(client: httpx.Client, base_url: str, iin: str) -> Family:
-    family_data = get_data(client=client, api_url=f'{base_url}/api/card/familyInfo', iin=iin)
-
+def get_family(family_data: Dict, person_details: List[List[str]], iin: str) -> Family:
     if not family_exists(family_data=family_data):
         raise FamilyNotFound()
 
     family = Family()
 
     family.members = get_member_data(family_data=family_data, iin=iin)
-    asyncio.run(update_social_status(family=family, client=client, base_url=base_url))
+    update_social_status(family=family, person_details=person_details)
     
     family_quality = family_data['family']['familyQuality']
 
-    family.member_cnt = family_quality['cntMem']
-    family.child_cnt = family_quality['cntChild']
+    family.member_cnt = get_value(family_quality['cntMem'])
+    family.child_cnt = get_value(family_quality['cntChild'])
     family.family_level = family_quality['tzhsDictionary']['nameRu']
     family.address = family_data['addressRu']
 
@@ -153,23 +257,151 @@ def get_family(client: httpx.Client, base_url: str, iin: str) -> Family:
     return family
 
 
-def get_family_data(iin: str or None) -> Dict: 
+async def report_family_info(family_info: asyncio.Future, family_task: asyncio.Future, iin: str, progress: Progress) -> None:
+    # the members and the family card are shown as soon as familyInfo is there,
+    # unless the person details turned out to be ready as well
+    await asyncio.wait({family_info, family_task}, return_when=asyncio.FIRST_COMPLETED)
+    if family_info.done() and not family_task.done():
+        family = get_family(family_data=family_info.result(), person_details=[], iin=iin)
+        progress('family', family.to_dict())
+
+
+async def fetch_family_data(iin: str, progress: Optional[Progress] = None) -> Dict:
+    token_manager = get_token_manager()
+    base_url = token_manager.base_url
+
+    # familyInfo and the person details do not depend on the section check,
+    # so they are fetched speculatively while the 15 sections are being probed.
+    family_info = asyncio.get_running_loop().create_future()
+    family_task = asyncio.ensure_future(fetch_family(token_manager=token_manager, base_url=base_url, iin=iin, family_info=family_info))
+    try:
+        with timed('sections'):
+            in_sections = await run_stage('sections', is_family_in_required_section(token_manager=token_manager, base_url=base_url, iin=iin))
+        if not in_sections:
+            raise IINNotInSections()
+        if progress is not None:
+            progress('sections', {})
+            await report_family_info(family_info=family_info, family_task=family_task, iin=iin, progress=progress)
+        family_data, person_details = await family_task
+    finally:
+        if not family_task.done():
+            family_task.cancel()
+        elif not family_task.cancelled():
+            family_task.exception()
+
+    with timed('entities'):
+        family = get_family(family_data=family_data, person_details=person_details, iin=iin)
+        profile = family.to_dict()
+    record_family(iin=iin, family=family, fetched_at=time.time())
+    return profile
+
+
+async def revalidate_family_data(iin: str) -> None:
+    profile_cache = get_profile_cache()
+    try:
+        profile = await fetch_family_data(iin=iin)
+    except (FamilyNotFound, IINNotInSections):
+        await run_blocking(profile_cache.delete, iin)
+    except Exception:
+        logger.exception(f'Could not revalidate profile {iin}')
+        await run_blocking(profile_cache.release_revalidation, iin)
+    else:
+        await run_blocking(profile_cache.set, iin, profile)
+
+
+async def wait_for_lookup(iin: str, started_at: float) -> Optional[Dict]:
+    """Waits for the lookup another worker holds the lease for. Returns its profile, raises its error
+    or returns None if the lookup failed otherwise or its lease expired, so the caller can take over.
+    """
+    profile_cache = get_profile_cache()
+    while True:
+        await asyncio.sleep(LOOKUP_POLL_INTERVAL)
+        # the profile is stored before the lease is released, so the state has to be read first
+        state = await run_blocking(profile_cache.get_lookup, iin)
+        cached = await run_blocking(profile_cache.get, iin)
+        if cached is not None:
+            return cached.profile
+        if state is None or state.lease_until < time.time():
+            if state is not None and state.error in LOOKUP_ERRORS and state.finished_at >= started_at:
+                raise LOOKUP_ERRORS[state.error]()
+            return None
+
+
+async def load_family_data(iin: str, progress: Optional[Progress] = None) -> Dict:
+    profile_cache = get_profile_cache()
+    started_at = time.time()
+    while not await run_blocking(profile_cache.acquire_lookup, iin):
+        profile = await wait_for_lookup(iin=iin, started_at=started_at)
+        if profile is not None:
+            return profile
+
+    error = None
+    try:
+        profile = await fetch_family_data(iin=iin, progress=progress)
+        await run_blocking(profile_cache.set, iin, profile)
+        return profile
+    except tuple(LOOKUP_ERRORS.values()) as e:
+        error = type(e).__name__
+        raise
+    finally:
+        await run_blocking(profile_cache.release_lookup, iin, error)
+
+
+async def get_cached_profile(iin: str) -> Optional[CachedProfile]:
+    """The stored profile of the IIN or, failing that, of a relative's lookup, with the IIN's member first."""
+    profile_cache = get_profile_cache()
+    cached = await run_blocking(profile_cache.get, iin)
+    if cached is not None:
+        return cached
+
+    household = await run_blocking(profile_cache.get_household, iin)
+    if household is None or household[0] == iin:
+        return None
+    household_iin, member_iins = household
+    cached = await run_blocking(profile_cache.get, household_iin)
+    if cached is None:
+        return None
+    profile = select_member(profile=cached.profile, iin=iin, member_iins=member_iins)
+    if profile is None:
+        return None
+    cached.profile = profile
+    return cached
+
+
+async def get_family_data_async(iin: str or None, progress: Optional[Progress] = None) -> Dict:
     if iin is None or not is_valid_iin(iin=iin):
         raise WrongIIN()
 
-    base_url, username, password = get_env_vars()
-    user = User(username=username, password=password)
-    with httpx.Client(headers=get_headers(), timeout=None) as client:
-        auth_data = get_token(user=user, base_url=base_url, client=client)
-        token = auth_data['accessToken']
-        client.headers['Authorization'] = f'Bearer {token}'
+    profile_cache = get_profile_cache()
+    cached = await get_cached_profile(iin=iin)
+    if cached is not None:
+        if cached.is_stale and await run_blocking(profile_cache.claim_revalidation, cached.iin):
+            task = start_task(revalidate_family_data(iin=cached.iin))
+            _revalidations.add(task)
+            task.add_done_callback(_revalidations.discard)
+        return cached.profile
+
+    # concurrent lookups of the same IIN share one computation inside the worker,
+    # and load_family_data lets only one worker at a time fetch it from the upstream.
+    # Only the lookup that started the computation gets its progress events.
+    return await _lookups.do(key=iin, func=functools.partial(load_family_data, iin=iin, progress=progress))
+
+
+def get_family_data(iin: str or None) -> Dict:
+    with timed('lookup'):
+        return run_sync(get_family_data_async(iin=iin))
 
-        if not asyncio.run(is_family_in_required_section(client=client, base_url=base_url, iin=iin)):
-            raise IINNotInSections()
 
-        family = get_family(client=client, base_url=base_url, iin=iin)
+def iter_family_events(iin: str or None) -> Iterator[Tuple[str, Dict]]:
+    """Yields the progress events of a lookup as they happen, then ('done', profile).
+    Errors of the lookup are raised by the iterator.
+    """
+    async def lookup(put: Callable[[Tuple[str, Dict]], None]) -> None:
+        profile = await get_family_data_async(iin=iin, progress=lambda event, data: put((event, data)))
+        put(('done', profile))
 
-    return family.to_dict()
+    with timed('lookup'):
+        yield from run_iter(lookup)
 
 
 if __name__ == '__main__':
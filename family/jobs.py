@@ -0,0 +1,281 @@
+"""Report jobs. The profiles are looked up on the event loop of the worker that accepted the job,
+the XLSX or PDF file is rendered in a process pool, and any worker can report the status and serve the file.
+"""
+import asyncio
+import html
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import time
+import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Set
+
+try:
+    from family.batch import BatchResult, get_batch_concurrency, iter_batch_rows, lookup_families
+    from family.runtime import run_blocking, submit
+    from family.sqlite_store import SQLiteStore
+    from family.utils import Lazy
+except (ModuleNotFoundError, ImportError):
+    from batch import BatchResult, get_batch_concurrency, iter_batch_rows, lookup_families
+    from runtime import run_blocking, submit
+    from sqlite_store import SQLiteStore
+    from utils import Lazy
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOBS_PATH = 'cache/jobs.sqlite3'
+DEFAULT_JOBS_DIR = 'cache/jobs'
+DEFAULT_REPORT_PROCESSES = 2
+DEFAULT_JOB_TTL = 86400
+DEFAULT_JOB_TIMEOUT = 900
+REPORT_FORMATS = ('xlsx', 'pdf')
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PDF_CSS_PATH = os.path.join(ROOT_DIR, 'static', 'dist', 'css', 'output.css')
+JOB_FAILED_MSG = 'Не удалось сформировать отчет. Попробуйте еще раз'
+PDF_UNAVAILABLE_MSG = 'Формирование PDF недоступно: на сервере не установлены pdfkit и wkhtmltopdf'
+
+_jobs: Set[Future] = set()
+
+
+@dataclass
+class Job:
+    id: str
+    format: str
+    iins: List[str]
+    status: str
+    created_at: float
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+    path: Optional[str] = None
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in ('done', 'failed')
+
+    def get_download_name(self) -> str:
+        return f"{self.iins[0] if len(self.iins) == 1 else 'families'}.{self.format}"
+
+    def to_dict(self) -> Dict:
+        return {
+            'id': self.id,
+            'format': self.format,
+            'iin_cnt': len(self.iins),
+            'status': self.status,
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+            'error': self.error,
+        }
+
+
+class JobStore(SQLiteStore):
+    """Jobs in SQLite, so every gunicorn worker sees them. A job that is not finished after `timeout`
+    seconds (e.g. its worker was restarted) is reported as failed. Jobs and their files are dropped after `ttl`.
+    """
+
+    def __init__(self, path: str, directory: str, ttl: float, timeout: float):
+        self.directory = directory
+        self.ttl = ttl
+        self.timeout = timeout
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(path=path)
+
+    def create_tables(self, connection: sqlite3.Connection) -> None:
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id TEXT PRIMARY KEY, format TEXT NOT NULL, iins TEXT NOT NULL, status TEXT NOT NULL, '
+            'created_at REAL NOT NULL, finished_at REAL, error TEXT, path TEXT)'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS jobs_created_at ON jobs (created_at)')
+
+    def get_file_path(self, job_id: str, report_format: str) -> str:
+        return os.path.join(self.directory, f'{job_id}.{report_format}')
+
+    def create(self, report_format: str, iins: List[str]) -> Job:
+        job = Job(id=uuid.uuid4().hex, format=report_format, iins=iins, status='queued', created_at=time.time())
+        with self._connect() as connection:
+            connection.execute(
+                'INSERT INTO jobs (id, format, iins, status, created_at) VALUES (?, ?, ?, ?, ?)',
+                (job.id, job.format, json.dumps(iins), job.status, job.created_at)
+            )
+        self.cleanup()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        row = self._connect().execute(
+            'SELECT id, format, iins, status, created_at, finished_at, error, path FROM jobs WHERE id = ?', (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        job = Job(*row)
+        job.iins = json.loads(job.iins)
+        if not job.is_finished and time.time() - job.created_at > self.timeout:
+            job.status, job.error = 'failed', JOB_FAILED_MSG
+        return job
+
+    def set_status(self, job_id: str, status: str, error: Optional[str] = None, path: Optional[str] = None) -> None:
+        finished_at = time.time() if status in ('done', 'failed') else None
+        with self._connect() as connection:
+            connection.execute(
+                'UPDATE jobs SET status = ?, error = ?, path = ?, finished_at = ? WHERE id = ?',
+                (status, error, path, finished_at, job_id)
+            )
+
+    def cleanup(self) -> None:
+        with self._connect() as connection:
+            rows = connection.execute('SELECT path FROM jobs WHERE created_at < ?', (time.time() - self.ttl,)).fetchall()
+            for path, in rows:
+                if path:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+            connection.execute('DELETE FROM jobs WHERE created_at < ?', (time.time() - self.ttl,))
+
+
+_job_store = Lazy(lambda: JobStore(
+    path=os.getenv('REPORT_JOBS_PATH', DEFAULT_JOBS_PATH),
+    directory=os.getenv('REPORT_JOBS_DIR', DEFAULT_JOBS_DIR),
+    ttl=float(os.getenv('REPORT_JOB_TTL', DEFAULT_JOB_TTL)),
+    timeout=float(os.getenv('REPORT_JOB_TIMEOUT', DEFAULT_JOB_TIMEOUT))
+))
+
+
+def get_job_store() -> JobStore:
+    return _job_store.get()
+
+
+# spawned, not forked, because a fork would copy the event loop thread and its locks in whatever state they are in
+_process_pool = Lazy(lambda: ProcessPoolExecutor(
+    max_workers=int(os.getenv('REPORT_PROCESSES', DEFAULT_REPORT_PROCESSES)),
+    mp_context=multiprocessing.get_context('spawn')
+))
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """The render processes of the current worker."""
+    return _process_pool.get()
+
+
+def reset_process_pool(process_pool: ProcessPoolExecutor) -> None:
+    """Drops a pool whose process died (e.g. killed for memory), the next job starts a new one."""
+    _process_pool.reset(process_pool)
+    process_pool.shutdown(wait=False)
+
+
+def render_xlsx(results: List[BatchResult], path: str) -> None:
+    from excel.excel import get_batch_excel, get_excel
+
+    # a single family gets the portrait layout of /download_xlsx, several families one row each
+    if len(results) == 1:
+        excel = get_excel(family=results[0].family)
+    else:
+        excel = get_batch_excel(rows=iter_batch_rows(results=results))
+    with open(path, 'wb') as f:
+        f.write(excel.getbuffer())
+
+
+def is_pdf_available() -> bool:
+    try:
+        import pdfkit
+    except ImportError:
+        return False
+    try:
+        # looks up the wkhtmltopdf executable, raises OSError if there is none
+        pdfkit.configuration()
+    except OSError:
+        return False
+    return True
+
+
+def render_pdf(results: List[BatchResult], path: str) -> None:
+    import jinja2
+    import pdfkit
+
+    environment = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.join(ROOT_DIR, 'templates')), autoescape=True)
+    template = environment.get_template('family.html')
+    pages = [
+        template.render(family=result.family, data=result.iin) if result.family
+        else f'<p>{html.escape(result.iin)}: {html.escape(result.error or "")}</p>'
+        for result in results
+    ]
+    document = (
+        '<!DOCTYPE html><html><head><meta charset="utf-8"></head><body>'
+        + '<div style="page-break-after: always"></div>'.join(pages)
+        + '</body></html>'
+    )
+    css = PDF_CSS_PATH if os.path.exists(PDF_CSS_PATH) else None
+    pdfkit.from_string(document, path, css=css, options={'encoding': 'UTF-8', 'quiet': ''})
+
+
+def build_report(report_format: str, results: List[BatchResult], path: str) -> Optional[str]:
+    """Runs in a render process. Returns an error message instead of raising,
+    because the custom exceptions can not be sent back to the worker.
+    """
+    if report_format == 'pdf' and not is_pdf_available():
+        return PDF_UNAVAILABLE_MSG
+
+    tmp_path = f'{path}.tmp'
+    try:
+        if report_format == 'pdf':
+            render_pdf(results=results, path=tmp_path)
+        else:
+            render_xlsx(results=results, path=tmp_path)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logging.getLogger(__name__).error(f'Could not render report {path}: {e!r}')
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        return JOB_FAILED_MSG
+    return None
+
+
+async def run_job(job: Job, concurrency: int) -> None:
+    store = get_job_store()
+    await run_blocking(store.set_status, job.id, 'running')
+    try:
+        results = []
+        await lookup_families(results.append, iins=job.iins, concurrency=concurrency)
+        # lookups finish in any order, the report keeps the order of the request
+        positions = {iin: position for position, iin in enumerate(job.iins)}
+        results.sort(key=lambda result: positions[result.iin])
+
+        if len(results) == 1 and results[0].error:
+            await run_blocking(store.set_status, job.id, 'failed', results[0].error)
+            return
+
+        path = store.get_file_path(job_id=job.id, report_format=job.format)
+        process_pool = get_process_pool()
+        try:
+            error = await asyncio.get_running_loop().run_in_executor(process_pool, build_report, job.format, results, path)
+        except BrokenProcessPool:
+            reset_process_pool(process_pool=process_pool)
+            raise
+        if error:
+            await run_blocking(store.set_status, job.id, 'failed', error)
+        else:
+            await run_blocking(store.set_status, job.id, 'done', None, path)
+    except Exception:
+        logger.exception(f'Report job {job.id} failed')
+        await run_blocking(store.set_status, job.id, 'failed', JOB_FAILED_MSG)
+
+
+def submit_job(report_format: str, iins: List[str], concurrency: Optional[int] = None) -> Job:
+    """Stores the job and starts it on the process event loop without waiting for it."""
+    job = get_job_store().create(report_format=report_format, iins=iins)
+    future = submit(run_job(job=job, concurrency=get_batch_concurrency(concurrency)))
+    _jobs.add(future)
+    future.add_done_callback(_jobs.discard)
+    return job
+
+
+def get_job(job_id: str) -> Optional[Job]:
+    return get_job_store().get(job_id)
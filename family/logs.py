@@ -0,0 +1,143 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, Tuple
+
+try:
+    from family.utils import Lazy
+except (ModuleNotFoundError, ImportError):
+    from utils import Lazy
+
+
+DEFAULT_LOG_FILE = 'record.log'
+DEFAULT_LOG_LEVEL = 'INFO'
+DEFAULT_LOG_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_LOG_BACKUP_COUNT = 5
+DEFAULT_LOG_SAMPLE_RATE = 1.0
+DEFAULT_LOG_SAMPLED_LOGGERS = 'app.access,httpx'
+
+# id of the request being served; like the stage timings in metrics.py it is inherited
+# by the coroutines run_sync starts, so their records carry it as well
+_request_id = contextvars.ContextVar('request_id', default=None)
+_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'request_id'}
+
+
+def set_request_id(request_id: str) -> None:
+    _request_id.set(request_id)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line. Fields passed with `extra=` are added next to the standard ones."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'request_id', None):
+            data['request_id'] = record.request_id
+        data.update((key, value) for key, value in vars(record).items() if key not in _RECORD_FIELDS)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class LogQueueHandler(QueueHandler):
+    """Resolves everything that depends on the calling thread (message, traceback, request ID)
+    and leaves formatting and file I/O to the listener thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        record.request_id = _request_id.get()
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only `rate` of the records below WARNING from the high-volume loggers."""
+
+    def __init__(self, rate: float, loggers: Tuple[str, ...]):
+        super().__init__()
+        self.rate = rate
+        self.loggers = loggers
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate >= 1 or record.levelno >= logging.WARNING or not record.name.startswith(self.loggers):
+            return True
+        return random.random() < self.rate
+
+
+class SharedRotatingFileHandler(RotatingFileHandler):
+    """Every gunicorn worker has its own handler on the same file. A worker that finds the file
+    already rotated by another one reopens it instead of rotating it a second time.
+    """
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.stream is not None:
+            try:
+                rotated = os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+            except FileNotFoundError:
+                rotated = True
+            if rotated:
+                self.stream.close()
+                self.stream = self._open()
+        return super().shouldRollover(record)
+
+
+def get_log_settings() -> Dict:
+    return {
+        'filename': os.getenv('LOG_FILE', DEFAULT_LOG_FILE),
+        'level': os.getenv('LOG_LEVEL', DEFAULT_LOG_LEVEL).upper(),
+        'max_bytes': int(os.getenv('LOG_MAX_BYTES', DEFAULT_LOG_MAX_BYTES)),
+        'backup_count': int(os.getenv('LOG_BACKUP_COUNT', DEFAULT_LOG_BACKUP_COUNT)),
+        'sample_rate': float(os.getenv('LOG_SAMPLE_RATE', DEFAULT_LOG_SAMPLE_RATE)),
+        'sampled_loggers': tuple(filter(None, os.getenv('LOG_SAMPLED_LOGGERS', DEFAULT_LOG_SAMPLED_LOGGERS).split(','))),
+    }
+
+
+def start_listener() -> QueueListener:
+    settings = get_log_settings()
+    file_handler = SharedRotatingFileHandler(
+        settings['filename'], maxBytes=settings['max_bytes'], backupCount=settings['backup_count'], encoding='utf-8'
+    )
+    file_handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(rate=settings['sample_rate'], loggers=settings['sampled_loggers']))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(settings['level'])
+    logging.getLogger('httpcore').setLevel(logging.WARNING)
+
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+_listener = Lazy(start_listener)
+
+
+def setup_logging() -> None:
+    """Routes the root logger through a queue to a listener thread that writes rotated JSON lines,
+    so requests never wait for the disk. Called once per worker process.
+    """
+    _listener.get()
@@ -0,0 +1,137 @@
+import contextvars
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+
+DEFAULT_METRICS_DIR = 'cache/metrics'
+DUMP_INTERVAL = 1
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+STAGES = ('login', 'sections', 'family_info', 'person_details', 'entities', 'lookup', 'xlsx')
+METRIC_NAME = 'family_lookup_stage_seconds'
+
+# stage durations of the request being served; set by the Flask app and inherited by
+# the coroutines run_sync starts on the event loop, because they copy the caller's context.
+# Background work is started with runtime.start_task/submit in an empty context, so it does not count
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self) -> Dict:
+        return {'counts': self.counts, 'sum': self.sum, 'count': self.count}
+
+    def merge(self, data: Dict) -> None:
+        self.counts = [a + b for a, b in zip(self.counts, data['counts'])]
+        self.sum += data['sum']
+        self.count += data['count']
+
+
+class Metrics:
+    """Per-process stage histograms. Every worker dumps a snapshot to `directory` at most once per
+    DUMP_INTERVAL, and /metrics adds up the snapshots so the numbers cover all gunicorn workers.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.histograms: Dict[str, Histogram] = {stage: Histogram() for stage in STAGES}
+        self._lock = threading.Lock()
+        self._dumped_at = 0.0
+
+    def observe(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.histograms.setdefault(stage, Histogram()).observe(seconds)
+            is_dump_due = time.monotonic() - self._dumped_at > DUMP_INTERVAL
+            if is_dump_due:
+                self._dumped_at = time.monotonic()
+
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + seconds
+
+        # observe runs on the event loop too, so the file is written in a thread of its own
+        if is_dump_due:
+            threading.Thread(target=self.dump, name='metrics-dump', daemon=True).start()
+
+    def dump(self) -> None:
+        with self._lock:
+            self._dumped_at = time.monotonic()
+            snapshot = {stage: histogram.to_dict() for stage, histogram in self.histograms.items()}
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+
+    def collect(self) -> Dict[str, Histogram]:
+        self.dump()
+        histograms: Dict[str, Histogram] = {stage: Histogram() for stage in STAGES}
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for stage, data in snapshot.items():
+                histograms.setdefault(stage, Histogram()).merge(data)
+        return histograms
+
+    def render(self) -> str:
+        lines = [
+            f'# HELP {METRIC_NAME} Duration of the family lookup stages in seconds.',
+            f'# TYPE {METRIC_NAME} histogram',
+        ]
+        for stage, histogram in self.collect().items():
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                cumulative += count
+                lines.append(f'{METRIC_NAME}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'{METRIC_NAME}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'{METRIC_NAME}_sum{{stage="{stage}"}} {histogram.sum}')
+            lines.append(f'{METRIC_NAME}_count{{stage="{stage}"}} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics(directory=os.getenv('METRICS_DIR', DEFAULT_METRICS_DIR))
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe(stage=stage, seconds=time.perf_counter() - start_time)
+
+
+def start_request_timings() -> Dict[str, float]:
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+def get_server_timing(timings: Dict[str, float], total: Optional[float] = None) -> str:
+    entries: List[str] = [f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in timings.items()]
+    if total is not None:
+        entries.append(f'total;dur={total * 1000:.1f}')
+    return ', '.join(entries)
@@ -0,0 +1,363 @@
+import asyncio
+import importlib.util
+import logging
+import math
+import os
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+import httpx
+
+try:
+    from family.custom_exceptions import NoVPNConnection
+except (ModuleNotFoundError, ImportError):
+    from custom_exceptions import NoVPNConnection
+
+
+DEFAULT_UPSTREAM_CONCURRENCY = 16
+DEFAULT_UPSTREAM_RETRIES = 2
+DEFAULT_RETRY_BACKOFF = 0.2
+DEFAULT_RETRY_MAX_BACKOFF = 2
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_RESET_TIMEOUT = 30
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 10
+STAGE_TIMEOUTS = {
+    'login': 5,
+    'sections': 10,
+    'family_info': 10,
+    'person_details': 15,
+}
+RETRY_STATUS_CODES = {502, 503, 504}
+DEFAULT_HEDGE_PERCENTILE = 95
+DEFAULT_HEDGE_BUDGET = 0.05
+DEFAULT_HEDGE_MIN_DELAY = 0.01
+DEFAULT_HEDGE_WINDOW = 500
+DEFAULT_HEDGE_MIN_SAMPLES = 50
+# unused hedges saved up during quiet periods, so a burst of slow calls can not spend more than this at once
+HEDGE_MAX_TOKENS = 10
+# samples between two recomputations of a hedge threshold
+HEDGE_REFRESH_SAMPLES = 10
+MIN_HEDGE_CONCURRENCY = 2
+
+logger = logging.getLogger(__name__)
+
+
+def get_stage_timeout(stage: str) -> float:
+    return float(os.getenv(f'UPSTREAM_TIMEOUT_{stage.upper()}', STAGE_TIMEOUTS[stage]))
+
+
+def get_client_timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        float(os.getenv('UPSTREAM_READ_TIMEOUT', DEFAULT_READ_TIMEOUT)),
+        connect=float(os.getenv('UPSTREAM_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT))
+    )
+
+
+def use_http2() -> bool:
+    """UPSTREAM_HTTP2=1 multiplexes the whole fan-out of a lookup over one connection instead of
+    opening one per parallel request. It needs the h2 package (pip install httpx[http2]); without it,
+    and with servers that do not offer h2 during the TLS handshake, the client speaks HTTP/1.1.
+    """
+    if os.getenv('UPSTREAM_HTTP2', '0').lower() not in ('1', 'true', 'yes'):
+        return False
+    if importlib.util.find_spec('h2') is None:
+        logger.warning('UPSTREAM_HTTP2 is set, but the h2 package is not installed, falling back to HTTP/1.1')
+        return False
+    return True
+
+
+async def run_stage(stage: str, coro: Awaitable[Any]) -> Any:
+    """Awaits one stage of a lookup within its time budget. A stage that runs out of time
+    is reported as an unreachable upstream, like the connection errors it usually stands for.
+    """
+    try:
+        return await asyncio.wait_for(coro, timeout=get_stage_timeout(stage))
+    except asyncio.TimeoutError:
+        raise NoVPNConnection()
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive connection failures and rejects calls
+    for `reset_timeout` seconds, after which a single trial call decides whether it closes again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        # a trial that never reported back (e.g. it was cancelled) is replaced after another reset_timeout
+        trial_pending = self._trial_at is not None and now - self._trial_at < self.reset_timeout
+        if not trial_pending and now - self.opened_at >= self.reset_timeout:
+            self._trial_at = now
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._trial_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._trial_at = None
+        if self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class Race:
+    """Requests racing for one answer, like the section probes. Once the race is won, `finish()` lets the
+    losers that already hold a slot complete in the background: aborting a request closes its HTTP/1.1
+    connection, and the next one pays for a new handshake. Losers still waiting for a slot, and all requests
+    of a race cancelled for any other reason (a stage timeout, a cancelled lookup), are aborted and free their slot.
+    """
+
+    def __init__(self):
+        self.won = False
+
+    def finish(self) -> None:
+        self.won = True
+
+
+class LatencyWindow:
+    """The latencies of the last `size` calls of one kind and their `percentile`,
+    recomputed every HEDGE_REFRESH_SAMPLES samples. No threshold until `min_samples` are in.
+    """
+
+    def __init__(self, size: int, percentile: float, min_samples: int):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.samples: Deque[float] = deque(maxlen=size)
+        self._threshold: Optional[float] = None
+        self._new_samples = 0
+
+    def observe(self, seconds: float) -> None:
+        self.samples.append(seconds)
+        self._new_samples += 1
+
+    def get_threshold(self) -> Optional[float]:
+        if len(self.samples) < self.min_samples:
+            return None
+        if self._threshold is None or self._new_samples >= HEDGE_REFRESH_SAMPLES:
+            ordered = sorted(self.samples)
+            self._threshold = ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile / 100))]
+            self._new_samples = 0
+        return self._threshold
+
+
+class Hedger:
+    """Races a second copy of a request that has been in flight longer than the `percentile` of the
+    recent requests of its kind and returns whichever copy answers first. Every request earns `budget`
+    of a hedge and every hedge spends a whole one, so hedges stay below `budget` of the requests
+    however slow the upstream gets. Hedges have `concurrency` slots per host of their own: a lookup's
+    fan-out alone fills the regular slots, and hedges must not take them from the next lookup either.
+    Only used from the process event loop.
+    """
+
+    def __init__(self, percentile: float, budget: float, min_delay: float, window: int, min_samples: int, concurrency: int):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_delay = min_delay
+        self.window = window
+        self.min_samples = min_samples
+        self.concurrency = concurrency
+        self.tokens = 0.0
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._windows: Dict[str, LatencyWindow] = {}
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def get_semaphore(self, host: str) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(host)
+        if semaphore is None:
+            semaphore = self._semaphores[host] = asyncio.Semaphore(self.concurrency)
+        return semaphore
+
+    def get_window(self, kind: str) -> LatencyWindow:
+        window = self._windows.get(kind)
+        if window is None:
+            window = self._windows[kind] = LatencyWindow(size=self.window, percentile=self.percentile, min_samples=self.min_samples)
+        return window
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'calls': self.calls,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'thresholds': {kind: window.get_threshold() for kind, window in self._windows.items()},
+        }
+
+    async def race(self, kind: str, primary: asyncio.Future,
+                   start_hedge: Callable[[], Awaitable[Optional[asyncio.Future]]]) -> Any:
+        """`primary` is a request that is already in flight; `start_hedge` sends a copy of it,
+        or returns None if it can not be sent right now. The losing copy is aborted, so a slow request
+        does not keep its slot until the read timeout.
+        """
+        window = self.get_window(kind)
+        threshold = window.get_threshold()
+        self.calls += 1
+        self.tokens = min(HEDGE_MAX_TOKENS, self.tokens + self.budget)
+
+        start_time = time.monotonic()
+        pending = {primary}
+        if threshold is not None:
+            done, _ = await asyncio.wait(pending, timeout=max(self.min_delay, threshold))
+            if not done and self.tokens >= 1:
+                hedge = await start_hedge()
+                if hedge is not None:
+                    self.tokens -= 1
+                    self.hedges += 1
+                    pending.add(hedge)
+
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # a copy that failed does not fail the request while the other one may still answer
+            succeeded = [task for task in done if task.exception() is None]
+            if succeeded:
+                winner = primary if primary in succeeded else succeeded[0]
+                if winner is not primary:
+                    self.hedge_wins += 1
+                # a hedged request is recorded with the time it took to get any answer,
+                # the primary alone would have taken at least that long
+                window.observe(time.monotonic() - start_time)
+                for task in pending:
+                    task.cancel()
+                return winner.result()
+        return primary.result()
+
+
+def create_hedger(concurrency: int) -> Optional[Hedger]:
+    """UPSTREAM_HEDGE=1 turns hedging on for the calls that ask for it (person details and section probes); off by default,
+    because every hedge is an extra request to the upstream. The hedge slots default to the budget's share
+    of the `concurrency` regular ones, at least two.
+    """
+    if os.getenv('UPSTREAM_HEDGE', '0').lower() not in ('1', 'true', 'yes'):
+        return None
+    budget = float(os.getenv('UPSTREAM_HEDGE_BUDGET', DEFAULT_HEDGE_BUDGET))
+    return Hedger(
+        percentile=float(os.getenv('UPSTREAM_HEDGE_PERCENTILE', DEFAULT_HEDGE_PERCENTILE)),
+        budget=budget,
+        min_delay=float(os.getenv('UPSTREAM_HEDGE_MIN_DELAY', DEFAULT_HEDGE_MIN_DELAY)),
+        window=int(os.getenv('UPSTREAM_HEDGE_WINDOW', DEFAULT_HEDGE_WINDOW)),
+        min_samples=int(os.getenv('UPSTREAM_HEDGE_MIN_SAMPLES', DEFAULT_HEDGE_MIN_SAMPLES)),
+        concurrency=int(os.getenv('UPSTREAM_HEDGE_CONCURRENCY', max(MIN_HEDGE_CONCURRENCY, math.ceil(concurrency * budget))))
+    )
+
+
+class Upstream:
+    """Guards every call to the upstream: per-host concurrency limit, retries with jittered
+    exponential backoff and a circuit breaker that fails fast with NoVPNConnection. A 502/503/504
+    that is left after the retries raises NoVPNConnection too.
+    Calls that pass `hedge` are raced against a copy when they are slow, if a hedger is set.
+    Only used from the process event loop.
+    """
+
+    def __init__(self, concurrency: int, retries: int, backoff: float, max_backoff: float, breaker: CircuitBreaker,
+                 hedger: Optional[Hedger] = None):
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker
+        self.hedger = hedger
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def get_semaphore(self, host: str) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(host)
+        if semaphore is None:
+            semaphore = self._semaphores[host] = asyncio.Semaphore(self.concurrency)
+        return semaphore
+
+    def _start(self, semaphore: asyncio.Semaphore, send: Callable[[], Awaitable[httpx.Response]]) -> asyncio.Future:
+        task = asyncio.ensure_future(send())
+
+        def release(task: asyncio.Future) -> None:
+            semaphore.release()
+            if not task.cancelled():
+                task.exception()
+
+        task.add_done_callback(release)
+        return task
+
+    async def _send_limited(self, host: str, send: Callable[[], Awaitable[httpx.Response]],
+                            hedge: Optional[str] = None, race: Optional[Race] = None) -> httpx.Response:
+        semaphore = self.get_semaphore(host)
+        await semaphore.acquire()
+        tasks = [self._start(semaphore=semaphore, send=send)]
+        try:
+            if hedge is None or self.hedger is None:
+                return await asyncio.shield(tasks[0])
+
+            async def start_hedge() -> Optional[asyncio.Future]:
+                # the hedge threshold only counts the time in flight, so a copy that would have
+                # to wait for a hedge slot is not sent, it would only be later than the primary
+                hedge_semaphore = self.hedger.get_semaphore(host)
+                if hedge_semaphore.locked():
+                    return None
+                await hedge_semaphore.acquire()
+                tasks.append(self._start(semaphore=hedge_semaphore, send=send))
+                return tasks[-1]
+
+            return await self.hedger.race(kind=hedge, primary=tasks[0], start_hedge=start_hedge)
+        except asyncio.CancelledError:
+            if race is None or not race.won:
+                for task in tasks:
+                    task.cancel()
+            raise
+
+    async def send(self, host: str, send: Callable[[], Awaitable[httpx.Response]], idempotent: bool = True,
+                   hedge: Optional[str] = None, race: Optional[Race] = None) -> httpx.Response:
+        attempts = self.retries + 1 if idempotent else 1
+        for attempt in range(attempts):
+            if not self.breaker.allow():
+                raise NoVPNConnection()
+
+            last_attempt = attempt == attempts - 1
+            try:
+                response = await self._send_limited(host=host, send=send, hedge=hedge, race=race)
+            except httpx.TransportError as e:
+                self.breaker.record_failure()
+                if last_attempt or self.breaker.is_open:
+                    raise NoVPNConnection() from e
+            else:
+                if response.status_code not in RETRY_STATUS_CODES:
+                    self.breaker.record_success()
+                    return response
+                self.breaker.record_failure()
+                if last_attempt or self.breaker.is_open:
+                    # the callers read the JSON body, a gateway error page is an outage like a failed connect
+                    raise NoVPNConnection()
+
+            await asyncio.sleep(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+
+
+def create_upstream(concurrency: Optional[int] = None) -> Upstream:
+    """Every upstream has its own slots and circuit breaker; `concurrency` overrides UPSTREAM_CONCURRENCY."""
+    if concurrency is None:
+        concurrency = int(os.getenv('UPSTREAM_CONCURRENCY', DEFAULT_UPSTREAM_CONCURRENCY))
+    return Upstream(
+        concurrency=concurrency,
+        retries=int(os.getenv('UPSTREAM_RETRIES', DEFAULT_UPSTREAM_RETRIES)),
+        backoff=float(os.getenv('UPSTREAM_RETRY_BACKOFF', DEFAULT_RETRY_BACKOFF)),
+        max_backoff=float(os.getenv('UPSTREAM_RETRY_MAX_BACKOFF', DEFAULT_RETRY_MAX_BACKOFF)),
+        breaker=CircuitBreaker(
+            failure_threshold=int(os.getenv('UPSTREAM_BREAKER_THRESHOLD', DEFAULT_BREAKER_THRESHOLD)),
+            reset_timeout=float(os.getenv('UPSTREAM_BREAKER_RESET_TIMEOUT', DEFAULT_BREAKER_RESET_TIMEOUT))
+        ),
+        hedger=create_hedger(concurrency=concurrency)
+    )
+
@@ -0,0 +1,85 @@
+import asyncio
+import contextvars
+import functools
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Coroutine, Iterator, Optional
+
+try:
+    from family.utils import Lazy
+except (ModuleNotFoundError, ImportError):
+    from utils import Lazy
+
+
+def _run_forever(loop: asyncio.AbstractEventLoop) -> None:
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+def start_loop() -> asyncio.AbstractEventLoop:
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=_run_forever, args=(loop,), name='upstream-loop', daemon=True).start()
+    return loop
+
+
+_loop = Lazy(start_loop)
+
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """Returns the event loop of the current process, starting it in a daemon thread on first use.
+    All upstream calls of a worker run on this loop, so the pooled async client is shared between requests.
+    """
+    return _loop.get()
+
+
+def run_sync(coro: Coroutine[Any, Any, Any], timeout: Optional[float] = None) -> Any:
+    """Runs a coroutine on the process event loop and blocks the calling thread until it is done."""
+    future = asyncio.run_coroutine_threadsafe(coro, get_loop())
+    try:
+        return future.result(timeout=timeout)
+    except BaseException:
+        future.cancel()
+        raise
+
+
+def start_task(coro: Coroutine[Any, Any, Any]) -> asyncio.Future:
+    """Starts a background coroutine on the running loop in an empty context. A task copies the context
+    it is created in, so it would otherwise add its stage timings to the request that happened to start it.
+    """
+    return contextvars.Context().run(asyncio.ensure_future, coro)
+
+
+def submit(coro: Coroutine[Any, Any, Any]) -> Future:
+    """Like start_task, but from any thread: starts the coroutine on the process event loop without waiting for it."""
+    return contextvars.Context().run(asyncio.run_coroutine_threadsafe, coro, get_loop())
+
+
+async def run_blocking(func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Runs blocking I/O (SQLite, files) in the default executor so it never stalls the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+
+def run_iter(func: Callable[[Callable[[Any], None]], Coroutine[Any, Any, Any]]) -> Iterator[Any]:
+    """Runs `func(put)` on the process event loop and yields everything it passes to `put`
+    in the calling thread, as soon as it is put. Closing the iterator cancels the coroutine.
+    """
+    items = queue.Queue()
+    done = object()
+
+    async def run() -> None:
+        try:
+            await func(items.put)
+        finally:
+            items.put(done)
+
+    future = asyncio.run_coroutine_threadsafe(run(), get_loop())
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                break
+            yield item
+        future.result()
+    finally:
+        future.cancel()
@@ -0,0 +1,218 @@
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from typing import Dict, List
+
+try:
+    from family.auth import TokenManager, get_token_manager
+    from family.resilience import Upstream, create_upstream
+    from family.runtime import run_blocking, run_sync, start_task
+    from family.sections import REQUIRED_SECTIONS
+    from family.sqlite_store import SQLiteStore
+    from family.utils import Lazy
+except (ModuleNotFoundError, ImportError):
+    from auth import TokenManager, get_token_manager
+    from resilience import Upstream, create_upstream
+    from runtime import run_blocking, run_sync, start_task
+    from sections import REQUIRED_SECTIONS
+    from sqlite_store import SQLiteStore
+    from utils import Lazy
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INDEX_PATH = 'cache/sections.sqlite3'
+DEFAULT_SYNC_INTERVAL = 3600
+DEFAULT_SYNC_PAGE_SIZE = 1000
+DEFAULT_SYNC_LEASE_TIMEOUT = 300
+DEFAULT_INDEX_MAX_AGE = 86400
+DEFAULT_SYNC_CONCURRENCY = 2
+SYNC_CHECK_INTERVAL = 60
+
+
+class SectionIndex(SQLiteStore):
+    """IIN -> required sections, filled by paging through every section of stat/page and by the hits
+    of live probes. Shared by all gunicorn workers through SQLite; a lease per section lets one worker
+    at a time sync it. Members a section sync did not see again are dropped when the sync completes.
+    """
+
+    def __init__(self, path: str, max_age: float, lease_timeout: float):
+        self.max_age = max_age
+        self.lease_timeout = lease_timeout
+        super().__init__(path=path)
+
+    def create_tables(self, connection: sqlite3.Connection) -> None:
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS members ('
+            'iin TEXT NOT NULL, section INTEGER NOT NULL, synced_at REAL NOT NULL, PRIMARY KEY (iin, section)'
+            ') WITHOUT ROWID'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS members_section ON members (section, synced_at)')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS syncs ('
+            'section INTEGER PRIMARY KEY, synced_at REAL NOT NULL DEFAULT 0, lease_until REAL NOT NULL DEFAULT 0, total INTEGER)'
+        )
+
+    def contains(self, iin: str) -> bool:
+        row = self._connect().execute(
+            'SELECT 1 FROM members WHERE iin = ? AND synced_at >= ? LIMIT 1', (iin, time.time() - self.max_age)
+        ).fetchone()
+        return row is not None
+
+    def add(self, section: int, iins: List[str], synced_at: float) -> None:
+        with self._connect() as connection:
+            connection.executemany(
+                'INSERT INTO members (iin, section, synced_at) VALUES (?, ?, ?) '
+                'ON CONFLICT (iin, section) DO UPDATE SET synced_at = max(synced_at, excluded.synced_at)',
+                [(iin, section, synced_at) for iin in iins]
+            )
+
+    def claim_sync(self, section: int, interval: float) -> bool:
+        """Takes the lease for syncing a section that was last synced more than `interval` seconds ago.
+        Returns False if it is fresh or another worker syncs it.
+        """
+        now = time.time()
+        with self._connect() as connection:
+            cursor = connection.execute(
+                'INSERT INTO syncs (section, synced_at, lease_until) VALUES (?, 0, ?) '
+                'ON CONFLICT (section) DO UPDATE SET lease_until = excluded.lease_until '
+                'WHERE syncs.lease_until < ? AND syncs.synced_at < ?',
+                (section, now + self.lease_timeout, now, now - interval)
+            )
+        return cursor.rowcount == 1
+
+    def renew_sync(self, section: int) -> None:
+        with self._connect() as connection:
+            connection.execute('UPDATE syncs SET lease_until = ? WHERE section = ?', (time.time() + self.lease_timeout, section))
+
+    def finish_sync(self, section: int, started_at: float, total: int) -> None:
+        with self._connect() as connection:
+            connection.execute('DELETE FROM members WHERE section = ? AND synced_at < ?', (section, started_at))
+            connection.execute(
+                'UPDATE syncs SET synced_at = ?, lease_until = 0, total = ? WHERE section = ?', (started_at, total, section)
+            )
+
+    def release_sync(self, section: int) -> None:
+        with self._connect() as connection:
+            connection.execute('UPDATE syncs SET lease_until = 0 WHERE section = ?', (section,))
+
+    def get_totals(self) -> Dict[int, int]:
+        rows = self._connect().execute('SELECT section, COUNT(*) FROM members GROUP BY section').fetchall()
+        return dict(rows)
+
+
+_section_index = Lazy(lambda: SectionIndex(
+    path=os.getenv('SECTION_INDEX_PATH', DEFAULT_INDEX_PATH),
+    max_age=float(os.getenv('SECTION_INDEX_MAX_AGE', DEFAULT_INDEX_MAX_AGE)),
+    lease_timeout=float(os.getenv('SECTION_SYNC_LEASE_TIMEOUT', DEFAULT_SYNC_LEASE_TIMEOUT))
+))
+_sync_upstream = Lazy(lambda: create_upstream(concurrency=get_sync_concurrency()))
+_sync_task = Lazy(lambda: start_task(run_section_sync(
+    interval=get_sync_interval(),
+    page_size=int(os.getenv('SECTION_SYNC_PAGE_SIZE', DEFAULT_SYNC_PAGE_SIZE))
+)))
+
+
+def get_section_index() -> SectionIndex:
+    return _section_index.get()
+
+
+def get_sync_interval() -> float:
+    return float(os.getenv('SECTION_SYNC_INTERVAL', DEFAULT_SYNC_INTERVAL))
+
+
+def get_sync_concurrency() -> int:
+    return int(os.getenv('SECTION_SYNC_CONCURRENCY', DEFAULT_SYNC_CONCURRENCY))
+
+
+def get_sync_upstream() -> Upstream:
+    """The sync's own concurrency limit and circuit breaker, so it never takes the slots of the lookups
+    and a slow 1000-row page can not open their breaker. Only called from the process event loop.
+    """
+    return _sync_upstream.get()
+
+
+async def sync_section(token_manager: TokenManager, index: SectionIndex, section: int, page_size: int) -> int:
+    """Pages through all members of a section. The caller must hold the section's lease."""
+    api_url = f'{token_manager.base_url}/api/workspace/stat/page'
+    started_at = time.time()
+    fetched = 0
+    page = 1
+    try:
+        while True:
+            payload = {'regionid': None, 'actioncode': '', 'countid': section, 'iin': '', 'page': page, 'size': page_size}
+            response = await token_manager.post(url=api_url, upstream=get_sync_upstream(), json=payload)
+            data = response.json()
+            iins = [record['iin'] for record in data['content']]
+            await run_blocking(index.add, section, iins, started_at)
+            await run_blocking(index.renew_sync, section)
+            fetched += len(iins)
+            if not iins or fetched >= data['total']:
+                break
+            page += 1
+    except BaseException:
+        await run_blocking(index.release_sync, section)
+        raise
+
+    await run_blocking(index.finish_sync, section, started_at, fetched)
+    return fetched
+
+
+async def sync_sections(interval: float, page_size: int) -> Dict[int, int]:
+    """Syncs every section that is older than `interval` and not being synced by another worker,
+    SECTION_SYNC_CONCURRENCY of them at a time. A section's lease is only claimed when its turn comes,
+    so it does not run out while the section waits. Returns the number of members fetched per synced section.
+    """
+    token_manager = get_token_manager()
+    index = get_section_index()
+    sections = list(REQUIRED_SECTIONS)
+    fetched = {}
+
+    async def sync_next() -> None:
+        while sections:
+            section = sections.pop(0)
+            if not await run_blocking(index.claim_sync, section, interval):
+                continue
+            try:
+                fetched[section] = await sync_section(token_manager=token_manager, index=index, section=section, page_size=page_size)
+            except Exception as e:
+                logger.error(f'Could not sync section {section}: {e!r}')
+
+    await asyncio.gather(*[sync_next() for _ in range(get_sync_concurrency())])
+    return fetched
+
+
+async def run_section_sync(interval: float, page_size: int) -> None:
+    while True:
+        try:
+            await sync_sections(interval=interval, page_size=page_size)
+        except Exception:
+            logger.exception('Section sync failed')
+        await asyncio.sleep(min(interval, SYNC_CHECK_INTERVAL))
+
+
+def start_section_sync() -> None:
+    """Starts the periodic sync in the current worker, once. Must be called on the process event loop.
+    SECTION_SYNC_INTERVAL=0 turns it off, the index then only learns from live probes.
+    """
+    if get_sync_interval() > 0:
+        _sync_task.get()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Sync the local index of the required sections from stat/page')
+    parser.add_argument('--force', action='store_true', help='sync every section, even if it is fresh')
+    parser.add_argument('--page-size', type=int, default=int(os.getenv('SECTION_SYNC_PAGE_SIZE', DEFAULT_SYNC_PAGE_SIZE)))
+    args = parser.parse_args()
+
+    interval = 0 if args.force else get_sync_interval()
+    fetched = run_sync(sync_sections(interval=interval, page_size=args.page_size))
+    for section, total in get_section_index().get_totals().items():
+        print(f'{section}: {total} members' + (f' ({fetched[section]} synced)' if section in fetched else ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+from typing import Dict, List
+
+
+REQUIRED_SECTIONS = [123, 120, 132, 131, 122, 121, 101, 130, 125, 126, 134, 124, 100, 93, 127]
+
+
+class SectionStats:
+    """Hit rate of every required section, learned from completed probes.
+    Only touched from the process event loop, so no locking is needed.
+    """
+
+    def __init__(self, sections: List[int]):
+        self.sections = list(sections)
+        self.hits: Dict[int, int] = {section: 0 for section in sections}
+        self.probes: Dict[int, int] = {section: 0 for section in sections}
+
+    def record(self, section: int, hit: bool) -> None:
+        self.probes[section] += 1
+        if hit:
+            self.hits[section] += 1
+
+    def get_hit_rate(self, section: int) -> float:
+        # Laplace smoothing keeps unseen sections at 0.5 instead of 0
+        return (self.hits[section] + 1) / (self.probes[section] + 2)
+
+    def get_order(self) -> List[int]:
+        # sorted() is stable, so sections with equal hit rates keep the configured order
+        return sorted(self.sections, key=self.get_hit_rate, reverse=True)
+
+
+section_stats = SectionStats(sections=REQUIRED_SECTIONS)
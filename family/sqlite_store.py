@@ -0,0 +1,33 @@
+import os
+import sqlite3
+import threading
+
+
+class SQLiteStore:
+    """Base of the stores all gunicorn workers share through one SQLite file in WAL mode.
+    Subclasses set their attributes before calling __init__ and create their tables in `create_tables`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            self.create_tables(connection=connection)
+
+    def create_tables(self, connection: sqlite3.Connection) -> None:
+        raise NotImplementedError
+
+    def _connect(self) -> sqlite3.Connection:
+        # sqlite3 connections can not be shared between threads, so every thread gets its own
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
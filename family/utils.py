@@ -1,9 +1,14 @@
+import functools
 import os
+import threading
 import time
-from typing import Any, Callable, Dict, Tuple
+from typing import Any, Callable, Dict, Generic, Optional, Tuple, TypeVar
 import dotenv
 
 
+T = TypeVar('T')
+
+
 def timer(func: Callable[..., Any]) -> Callable[..., Any]:
     """A decorator function that measures the time it takes for another function to execute.
     Args:
@@ -23,7 +28,38 @@ def timer(func: Callable[..., Any]) -> Callable[..., Any]:
     return wrapper
 
 
+class Lazy(Generic[T]):
+    """Creates an object on its first use, once per process even if several threads ask for it at the same time.
+    A forked gunicorn worker creates its own instead of using the one copied from the master.
+    """
+
+    def __init__(self, create: Callable[[], T]):
+        self._create = create
+        self._value: Optional[T] = None
+        self._pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> T:
+        pid = os.getpid()
+        if self._value is not None and self._pid == pid:
+            return self._value
+
+        with self._lock:
+            if self._value is None or self._pid != pid:
+                self._value = self._create()
+                self._pid = pid
+        return self._value
+
+    def reset(self, value: T) -> None:
+        """Drops `value` if it is still the current one, the next get creates a new one."""
+        with self._lock:
+            if self._value is value:
+                self._value = None
+
+
+@functools.lru_cache(maxsize=None)
 def get_env_vars() -> Tuple:
+    # .env is read and checked once per process; a failed check is not cached
     dotenv.load_dotenv()
     base_url, username, password = os.getenv('URL'), os.getenv('USR'), os.getenv('PSW')
     if not bool(base_url and username and password):
@@ -35,18 +71,21 @@ def is_valid_iin(iin: str) -> bool:
     return len(iin) == 12 and next((True for c in iin if c.isdigit()), False)
 
 
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/111.0',
+    'Accept': 'application/json, text/plain, */*',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Accept-Encoding': 'gzip, deflate',
+    'Content-Type': 'application/json',
+    'DNT': '1',
+    'Connection': 'keep-alive',
+    'Pragma': 'no-cache',
+    'Cache-Control': 'no-cache'
+}
+
+
 def get_headers() -> Dict[str, str]:
-    return {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/111.0',
-        'Accept': 'application/json, text/plain, */*',
-        'Accept-Language': 'en-US,en;q=0.5',
-        'Accept-Encoding': 'gzip, deflate',
-        'Content-Type': 'application/json',
-        'DNT': '1',
-        'Connection': 'keep-alive',
-        'Pragma': 'no-cache',
-        'Cache-Control': 'no-cache'
-    }
+    return HEADERS
 
 
 def get_risk_dict() -> Dict[str, Dict[str, str]]:
@@ -110,3 +149,9 @@ def get_social_status_dict() -> Dict[str, int]:
         'Беженцы': 0,
     }
 
+
+# fixed positions of the lookup tables, shared by every Family instance
+RISK_CODES = tuple(get_risk_dict())
+RISK_INDEX = {code: i for i, code in enumerate(RISK_CODES)}
+SOCIAL_STATUSES = tuple(get_social_status_dict())
+SOCIAL_STATUS_INDEX = {name: i for i, name in enumerate(SOCIAL_STATUSES)}
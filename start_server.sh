@@ -1,2 +1,5 @@
 #!/bin/bash
-gunicorn -w 4 --bind 0.0.0.0:8000 'app:flask_app' --log-file record.log --log-level DEBUG --reload
+rm -rf cache/metrics
+# /batch streams its rows from a sync worker, which can not heartbeat while it does,
+# so the default 30 s timeout would kill the worker in the middle of a long batch
+gunicorn -w 4 --bind 0.0.0.0:8000 'app:flask_app' --timeout "${GUNICORN_TIMEOUT:-900}" --error-logfile gunicorn.log --log-level info
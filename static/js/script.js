@@ -3,13 +3,67 @@ form.action = window.location.href;
 
 const submitButton = document.querySelector('button');
 const inputBox = document.querySelector('input');
+const familyContainer = document.querySelector('#family');
 
-submitButton.addEventListener('click', () => {
-  document.querySelector('form').submit()
+function setLoading() {
   submitButton.classList.add('loading');
   submitButton.disabled = true;
   submitButton.textContent = ' Ожидание...';
   const spinner = document.createElement('i');
   spinner.classList.add('fa', 'fa-spinner', 'fa-spin');
   submitButton.insertBefore(spinner, submitButton.firstChild);
+}
+
+function resetLoading() {
+  submitButton.classList.remove('loading');
+  submitButton.disabled = false;
+  submitButton.textContent = 'Запросить';
+}
+
+function showError(message) {
+  const error = document.createElement('div');
+  error.classList.add('error', 'w-1/6', 'py-1', 'mx-auto', 'text-center', 'font-bold', 'bg-red-600', 'border-2', 'rounded-lg', 'text-amber-200');
+  error.textContent = message;
+  form.after(error);
+}
+
+// the portrait is rendered piece by piece as the server streams it: the family card
+// as soon as the family is known, the social statuses once every member is looked up
+function streamFamily(iin) {
+  document.querySelectorAll('.error').forEach((error) => error.remove());
+  familyContainer.innerHTML = '';
+  setLoading();
+
+  const source = new EventSource(new URL('stream/family/' + encodeURIComponent(iin), window.location.href));
+  const render = (event) => {
+    familyContainer.innerHTML = JSON.parse(event.data).html;
+    formatPortrait();
+  };
+  source.addEventListener('family', render);
+  source.addEventListener('done', (event) => {
+    source.close();
+    render(event);
+    resetLoading();
+  });
+  source.addEventListener('error', (event) => {
+    source.close();
+    resetLoading();
+    // the error events of the server carry a message, a lost connection does not
+    showError(event.data ? JSON.parse(event.data).error : 'Нет ответа от сервера. Попробуйте еще раз');
+  });
+}
+
+form.addEventListener('submit', (event) => {
+  if (!window.EventSource) {
+    setLoading();
+    return;
+  }
+  event.preventDefault();
+  const iin = inputBox.value.trim();
+  if (iin === '') {
+    document.querySelectorAll('.error').forEach((error) => error.remove());
+    showError('Введите ИИН');
+    return;
+  }
+  streamFamily(iin);
 });